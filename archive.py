@@ -0,0 +1,133 @@
+import io
+import os
+import json
+import gzip
+import heapq
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+# zstd compresses better and faster, when it's available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+# Urls moved out of the database at a time
+BATCH_SIZE = 5000
+
+
+def archive_files(dir):
+    """Archive files in `dir`, newest month first"""
+    if not os.path.isdir(dir): return []
+    return sorted((os.path.join(dir, name) for name in os.listdir(dir)
+                   if name.endswith(('.ndjson.zst', '.ndjson.gz'))), reverse=True)
+
+
+def _write(path, records):
+    """Append records to an archive file. Each write is its own
+    zstd frame or gzip member, and these can be concatenated"""
+    data = ''.join(json.dumps(r) + '\n' for r in records).encode('utf8')
+    data = zstandard.ZstdCompressor().compress(data) if path.endswith('.zst') else gzip.compress(data)
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read(path):
+    """Read the records in an archive file"""
+    with open(path, 'rb') as f:
+        if path.endswith('.zst'):
+            if zstandard is None:
+                logger.warning("Skipping {}, the zstandard package isn't installed".format(path))
+                return
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        else:
+            reader = gzip.GzipFile(fileobj=f)
+        try:
+            for line in io.TextIOWrapper(reader, encoding='utf8'):
+                yield json.loads(line)
+        except (EOFError, OSError, ValueError, getattr(zstandard, 'ZstdError', OSError)) as e:
+            # A write may have been interrupted
+            logger.warning('Stopped reading {}, it may be truncated: {}'.format(path, e))
+
+
+def archive(db, dir, before, batch_size=BATCH_SIZE):
+    """Move urls last seen before `before`, with their sharers
+    and contexts, out of the database and into compressed ndjson
+    files in `dir`, one per month. Returns how many were archived"""
+    os.makedirs(dir, exist_ok=True)
+    ext = '.ndjson.zst' if zstandard is not None else '.ndjson.gz'
+    archived = 0
+    while True:
+        records = db.archivable(before, batch_size)
+        if not records: break
+
+        by_month = defaultdict(list)
+        for r in records:
+            by_month[datetime.fromtimestamp(r['last_seen']).strftime('%Y-%m')].append(r)
+        for month, rs in by_month.items():
+            _write(os.path.join(dir, month + ext), rs)
+
+        # Only deleted once they're safely archived
+        with db.batch():
+            db.delete_urls([r['url'] for r in records])
+        archived += len(records)
+
+    if archived:
+        db.prune_search()
+        db.compact()
+    return archived
+
+
+def _item(r):
+    """An archived url, as `Database.search` returns them"""
+    return {
+        'url': r['url'],
+        'users': ','.join(user for user, _ in r['users']),
+        'count': r['count'],
+        'last_seen': r['last_seen'],
+        'tweets': [{'id': g['id'], 'user': g['user'], 'text': g['text'],
+                    'subs': g['subs'], 'repeats': g['repeats']}
+                   for g in r['grouped'] if not g['retweet']],
+        'retweets': [{'id': g['id'], 'user': g['user'], 'text': g['text'],
+                      'retweeters': g['retweeters'].split()}
+                     for g in r['grouped'] if g['retweet']],
+    }
+
+
+def search(dir, query, limit=50, offset=0):
+    """Search archived urls for those whose url, title, description
+    or contexts contain every term in `query`, newest first.
+    Months are read newest first, until there are enough results"""
+    terms = query.lower().split()
+    if not terms: return []
+    results = []
+    seen = set()
+    for path in archive_files(dir):
+        # Only the newest matches in the month are needed,
+        # keep those in a heap, oldest on top
+        n = offset + limit - len(results)
+        newest = []
+        for r in _read(path):
+            # Urls may have been archived more than once,
+            # if an archive run was interrupted
+            if r['url'] in seen: continue
+            if len(newest) == n and r['last_seen'] <= newest[0][0]: continue
+            text = ' '.join([r['url'], r['title'] or '', r['description'] or ''] +
+                            [c['text'] for c in r['context']] +
+                            [s['text'] for c in r['context'] for s in c['sub']]).lower()
+            if all(term in text for term in terms):
+                seen.add(r['url'])
+                item = (r['last_seen'], r['url'], r)
+                if len(newest) < n:
+                    heapq.heappush(newest, item)
+                else:
+                    seen.discard(heapq.heappushpop(newest, item)[1])
+
+        results += [r for _, _, r in sorted(newest, reverse=True)]
+        if len(results) >= offset + limit: break
+    return [_item(r) for r in results[offset:offset+limit]]
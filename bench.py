@@ -0,0 +1,434 @@
+"""Offline benchmarks, run against a fake Twitter API and a local
+server of synthetic article pages, so runs can be compared:
+
+    python bench.py --users 500 --seed-urls 1000000 --json before.json
+    python bench.py --users 500 --seed-urls 1000000 --compare before.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import types
+import random
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# main reads its settings from config, use the benchmark's own
+config = types.ModuleType('config')
+config.MAX_ITEMS = 100
+sys.modules['config'] = config
+
+import main
+import metadata
+from db import Database, HOT_DECAY
+from matcher import KeywordMatcher
+from cache import MetadataCache, MembershipCache, RedirectCache
+from fetcher import TimelineFetcher, SharedFetcher, RateBudget
+
+logger = logging.getLogger()
+
+WORDS = ['climate', 'carbon', 'heat', 'flood', 'policy', 'energy', 'solar', 'wind',
+         'coal', 'ocean', 'forest', 'drought', 'storm', 'emissions', 'report', 'study']
+
+parser = argparse.ArgumentParser(description='Offline benchmarks for ingestion, RSS, metadata and the viewer')
+parser.add_argument('--users', type=int, default=300, help='Users in the fake timelines')
+parser.add_argument('--tweets', type=int, default=20, help='New tweets per timeline fetch')
+parser.add_argument('--articles', type=int, default=2000, help='Distinct articles tweets link to')
+parser.add_argument('--pages', type=int, default=500, help='Pages to fetch for the metadata benchmark')
+parser.add_argument('--latency', type=float, default=20, help='Article server latency, in ms')
+parser.add_argument('--page-size', type=int, default=50*1024, help='Article page size, in bytes')
+parser.add_argument('--api-latency', type=float, default=50, help='Fake timeline fetch latency, in ms')
+parser.add_argument('--seed-urls', type=int, default=100000, help='Urls to seed the viewer database with')
+parser.add_argument('--seed-days', type=int, default=7, help='Days the seeded urls are spread over')
+parser.add_argument('--queries', type=int, default=200, help='Queries per viewer benchmark')
+parser.add_argument('--clients', type=int, default=8, help='Concurrent clients for the viewer server')
+parser.add_argument('--keep', type=str, default=None, help='Directory to keep the generated data in')
+parser.add_argument('--json', type=str, default=None, help='Save results to this file')
+parser.add_argument('--compare', type=str, default=None, help='Compare results against an earlier run')
+parser.add_argument('--keywords', type=str, default='5,50,200,800', help='Comma-separated feed keyword counts to benchmark matching with')
+parser.add_argument('--verbose', action='store_true', help='Keep logging on')
+
+
+def result(name, seconds, count, latencies=None):
+    """Throughput and latency percentiles for a benchmark"""
+    res = {'name': name, 'count': count, 'seconds': seconds,
+           'per_second': count/seconds if seconds else None}
+    latencies = sorted(latencies or [])
+    for p in [50, 95, 99]:
+        res['p{}_ms'.format(p)] = latencies[min(len(latencies)-1, len(latencies)*p//100)]*1000 \
+            if latencies else None
+    return res
+
+
+def timed(fn, latencies):
+    """Wrap `fn`, recording how long each call takes"""
+    def wrapped(*args, **kwargs):
+        s = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - s)
+    return wrapped
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ArticleHandler(BaseHTTPRequestHandler):
+    """Serves synthetic article pages, with the
+    server's latency and padded to its page size"""
+    protocol_version = 'HTTP/1.1'
+
+    def page(self):
+        n = self.path.split('?')[0].rsplit('/', 1)[-1]
+        head = '<html><head><meta charset="utf-8"><title>Article {n}</title>\
+            <meta property="og:title" content="Article {n}">\
+            <meta property="og:description" content="About {word}, article {n}">\
+            </head><body>'.format(n=n, word=WORDS[int(n) % len(WORDS)] if n.isdigit() else '')
+        padding = max(0, self.server.page_size - len(head))
+        return (head + '<p>' + 'x'*padding + '</p></body></html>').encode('utf8')
+
+    def send_page(self, body):
+        time.sleep(self.server.latency)
+        page = self.page()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        if body: self.wfile.write(page)
+
+    def do_GET(self):
+        self.send_page(True)
+
+    def do_HEAD(self):
+        self.send_page(False)
+
+    def log_message(self, *args):
+        pass
+
+
+def article_server(latency, page_size):
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), ArticleHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.page_size = page_size
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeAPI:
+    """Stands in for `tweepy.API`, generating synthetic
+    timelines whose tweets link to the article server"""
+    def __init__(self, site, articles, tweets=20, latency=0):
+        self.site = site
+        self.tweets = tweets
+        self.latency = latency
+        self.last_response = None
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.fetched = 0
+
+        # A few articles are shared by many users, most by a few
+        self.articles = range(articles)
+        self.weights = [1/(i+1) for i in self.articles]
+
+    def _id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def _tweet(self, user_id, rand):
+        def status(id, user, text, urls):
+            return types.SimpleNamespace(
+                id=id, id_str=str(id), full_text=text,
+                user=types.SimpleNamespace(screen_name='user{}'.format(user)),
+                entities={'urls': [{'expanded_url': url} for url in urls]},
+                created_at=datetime.utcnow() - timedelta(minutes=rand.randint(1, 600)))
+
+        n, = rand.choices(self.articles, weights=self.weights)
+        url = '{}/articles/{}'.format(self.site, n)
+        if rand.random() < 0.3: url += '?utm_source=twitter&utm_medium=social'
+        text = ' '.join(rand.choice(WORDS) for _ in range(12))
+        if rand.random() < 0.2:
+            sub = status(self._id(), rand.randint(0, 50), text, [url])
+            t = status(self._id(), user_id, 'RT @{}: {}'.format(sub.user.screen_name, text), [])
+            t.retweeted_status = sub
+        else:
+            t = status(self._id(), user_id, '{} https://t.co/abc'.format(text), [url])
+        return t
+
+    def user_timeline(self, user_id, count=200, since_id=None, **kwargs):
+        time.sleep(self.latency)
+        rand = random.Random('{}-{}'.format(user_id, since_id))
+        tweets = [self._tweet(user_id, rand) for _ in range(min(count, self.tweets))]
+        with self.lock:
+            self.fetched += len(tweets)
+        return list(reversed(tweets))
+
+
+class FakeTimelineFetcher(TimelineFetcher):
+    def __init__(self, api, workers=4):
+        super().__init__(None, workers=workers, budget=RateBudget(limit=float('inf')))
+        self.api = api
+
+    def _api(self):
+        return self.api
+
+
+def caches(dir, users):
+    """Caches kept between ticks, with the fake users
+    as our friends so no membership fetches are made"""
+    os.makedirs(dir, exist_ok=True)
+    members = MembershipCache(os.path.join(dir, 'members'))
+    members._refresh('friends', lambda: users)
+    return (MetadataCache(os.path.join(dir, 'metadata')), members,
+            RedirectCache(os.path.join(dir, 'redirects')))
+
+
+def shared_fetcher(api, caches, workers=4):
+    """A tick's `SharedFetcher`, backed by the fake API"""
+    cache, members, redirects = caches
+    return SharedFetcher(api, FakeTimelineFetcher(api, workers), cache, members, redirects)
+
+
+def bench_matcher(keyword_counts, n_tweets=2000):
+    """`KeywordMatcher.match` as a feed's keywords grow,
+    over tweets that mostly don't match them"""
+    rand = random.Random(0)
+    def word(length):
+        return ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(length))
+    vocab = WORDS + [word(rand.randint(2, 10)) for _ in range(5000)]
+    tweets = [' '.join(rand.choice(vocab) for _ in range(rand.randint(10, 40))).capitalize()
+              for _ in range(n_tweets)]
+    results = []
+    for n in keyword_counts:
+        # Every fifth keyword is a phrase, and a tenth of the tweets mention one
+        keywords = [word(rand.randint(5, 10)) for _ in range(n)]
+        keywords = [kw if i % 5 else '{} {}'.format(kw, word(6)) for i, kw in enumerate(keywords)]
+        texts = [t if i % 10 else '{} {}'.format(t, rand.choice(keywords).upper())
+                 for i, t in enumerate(tweets)]
+        latencies = []
+        match = timed(KeywordMatcher(keywords).match, latencies)
+        for t in texts: match(t)
+        results.append(result('match.kw{}'.format(n), sum(latencies), n_tweets, latencies))
+    return results
+
+
+def bench_metadata(site, pages):
+    """Metadata extraction over distinct, uncached pages"""
+    latencies = []
+    urls = ['{}/pages/{}'.format(site, i) for i in range(pages)]
+    s = time.perf_counter()
+    fetched = metadata.get_metadata_many(urls, fetch=timed(metadata.get_metadata, latencies))
+    elapsed = time.perf_counter() - s
+    errors = sum(isinstance(m, Exception) for m in fetched.values())
+    if errors: logger.warning('{} metadata fetches failed'.format(errors))
+    return [result('metadata', elapsed, len(urls), latencies)]
+
+
+def bench_ingest(api, caches, feed_conf, ticks=2):
+    """`process_feed` throughput, in tweets per second. The
+    first tick fetches every url's metadata, later ones mostly hit the cache"""
+    results = []
+    for tick in range(ticks):
+        fetched = api.fetched
+        s = time.perf_counter()
+        main.process_feed(shared_fetcher(api, caches), feed_conf)
+        elapsed = time.perf_counter() - s
+        results.append(result('ingest.tick{}'.format(tick), elapsed, api.fetched - fetched))
+    return results
+
+
+def bench_rss(api, caches, feed_conf, reps=5):
+    """Compiling the RSS from scratch, from the ingested database"""
+    db = Database(os.path.join('data', feed_conf['id'], 'db'))
+    latencies = []
+    for _ in range(reps):
+        with db.batch():
+            db.cur.execute('DELETE FROM feed')
+        if os.path.exists(feed_conf['rss_path']):
+            os.remove(feed_conf['rss_path'])
+        timed(main.compile_rss, latencies)(db, 0, feed_conf, shared_fetcher(api, caches))
+    return [result('rss', sum(latencies), reps, latencies)]
+
+
+def generate_db(path, n_urls, days=7, users=5000, batch_size=10000):
+    """Seed a feed database with `n_urls` urls, spread over the
+    last `days`, each with a few sharers and their contexts"""
+    db = Database(path)
+    rand = random.Random(0)
+    now = datetime.now().timestamp()
+    start = now - days*24*60*60
+    id = 0
+    for i in range(0, n_urls, batch_size):
+        with db.batch():
+            for n in range(i, min(i + batch_size, n_urls)):
+                url = 'https://example.com/{}/article-{}'.format(WORDS[n % len(WORDS)], n)
+                ts = start + (now - start) * n/n_urls
+                sharers = rand.sample(range(users), min(users, 1 + int(rand.paretovariate(1.5))))
+                db.cur.execute('INSERT INTO urls(url, count, last_seen, title, description) VALUES (?, ?, ?, ?, ?)',
+                               (url, len(sharers), ts, 'Article {}'.format(n), 'About {}'.format(WORDS[n % len(WORDS)])))
+                db.cur.execute('INSERT INTO ranking VALUES (?, ?)', (url, ts * HOT_DECAY + math.log(len(sharers))))
+                for user in sharers:
+                    user = 'user{}'.format(user)
+                    id += 1
+                    db.cur.execute('INSERT INTO url_users VALUES (?, ?, ?)', (url, user, ts))
+                    text = ' '.join(rand.choice(WORDS) for _ in range(12))
+                    db.add_context(str(id), url, user, '{} https://t.co/abc'.format(text), [])
+        logger.warning('Seeded {}/{} urls'.format(min(i + batch_size, n_urls), n_urls))
+    db.con.close()
+
+
+def bench_queries(path, queries):
+    """`Database.since`, `Database.top` and `Database.search`, as the viewer uses them"""
+    db = Database(path, readonly=True)
+    rand = random.Random(0)
+    now = datetime.now().timestamp()
+    cutoff = now - 2*24*60*60
+
+    since = []
+    for _ in range(queries):
+        before = rand.uniform(cutoff, now)
+        timed(db.since, since)(cutoff, min_count=2, with_context=True, before=before, limit=50)
+
+    top = []
+    for _ in range(queries):
+        timed(db.top, top)(50, window=2*24*60*60, with_context=True)
+
+    search = []
+    for _ in range(queries):
+        query = ' '.join(rand.sample(WORDS, rand.randint(1, 2)))
+        timed(db.search, search)(query, limit=50, offset=rand.randint(0, 5)*50)
+    return [result('query.since', sum(since), queries, since),
+            result('query.top', sum(top), queries, top),
+            result('query.search', sum(search), queries, search)]
+
+
+def bench_server(path, queries, clients):
+    """Requests to the viewer, mostly missing its render cache"""
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                               '--db', path, '--port', str(port), '--workers', str(clients)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('localhost', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        rand = random.Random(0)
+        now = datetime.now().timestamp()
+        paths = []
+        for i in range(queries):
+            if i % 3 == 1:
+                paths.append('/?query={}&page={}'.format(rand.choice(WORDS), rand.randint(0, 5)))
+            elif i % 3 == 2:
+                paths.append('/?sort=hot&limit={}'.format(rand.randint(10, 100)))
+            else:
+                paths.append('/?before={}'.format(now - rand.uniform(0, 2*24*60*60)))
+
+        def get(path):
+            con = http.client.HTTPConnection('localhost', port, timeout=60)
+            con.request('GET', path)
+            con.getresponse().read()
+            con.close()
+
+        latencies = []
+        s = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            for _ in executor.map(timed(get, latencies), paths): pass
+        return [result('server', time.perf_counter() - s, queries, latencies)]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_results(results, previous=None):
+    previous = {r['name']: r for r in previous or []}
+    cols = ['count', 'seconds', 'per_second', 'p50_ms', 'p95_ms', 'p99_ms']
+    print('{:<16}'.format('') + ''.join('{:>12}'.format(c) for c in cols))
+    for res in results:
+        print('{:<16}'.format(res['name']) + ''.join(
+            '{:>12}'.format('-' if res[c] is None else '{:.2f}'.format(res[c])) for c in cols))
+        prev = previous.get(res['name'])
+        if prev is not None:
+            print('{:<16}'.format('  change') + ''.join(
+                '{:>12}'.format('-' if not prev[c] or res[c] is None else '{:+.1f}%'.format((res[c]/prev[c] - 1)*100))
+                for c in cols))
+
+
+def run(args):
+    results = []
+    logger.warning('Benchmarking keyword matching...')
+    results += bench_matcher([int(n) for n in args.keywords.split(',') if n])
+
+    site = article_server(args.latency/1000, args.page_size)
+    site_url = 'http://127.0.0.1:{}'.format(site.server_port)
+
+    logger.warning('Benchmarking metadata extraction...')
+    results += bench_metadata(site_url, args.pages)
+
+    logger.warning('Benchmarking ingestion...')
+    users = [str(u) for u in range(args.users)]
+    api = FakeAPI(site_url, args.articles, args.tweets, args.api_latency/1000)
+    tick_caches = caches('data', users)
+    feed_conf = {'id': 'bench', 'lists': [], 'min_count': 2,
+                 'url': 'http://localhost/bench.xml', 'rss_path': 'bench.xml'}
+    results += bench_ingest(api, tick_caches, feed_conf)
+
+    logger.warning('Benchmarking RSS compilation...')
+    results += bench_rss(api, tick_caches, feed_conf)
+    site.shutdown()
+
+    logger.warning('Seeding viewer database...')
+    path = os.path.abspath(os.path.join('data', 'seeded', 'db'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    s = time.perf_counter()
+    generate_db(path, args.seed_urls, args.seed_days)
+    results.append(result('seed', time.perf_counter() - s, args.seed_urls))
+
+    logger.warning('Benchmarking viewer queries...')
+    results += bench_queries(path, args.queries)
+    results += bench_server(path, args.queries, args.clients)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    cwd = os.getcwd()
+    dir = args.keep or tempfile.mkdtemp(prefix='audubon-bench-')
+    os.makedirs(dir, exist_ok=True)
+    os.chdir(dir)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        if args.keep is None:
+            shutil.rmtree(dir, ignore_errors=True)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import logging
+import metrics
+from threading import Lock, Thread
+from datetime import datetime
+
+logger = logging.getLogger()
+
+class MetadataCache:
+    """Disk-backed url metadata cache, shared across runs and feeds.
+    Failed fetches are cached too (with a shorter ttl),
+    as `{'url': url, 'error': '...'}`. Safe to share across threads."""
+    def __init__(self, path, ttl=7*24*60*60, error_ttl=60*60, max_size=100000):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.cur = self.con.cursor()
+        self.cur.execute('CREATE TABLE IF NOT EXISTS metadata \
+                         (url text primary key,\
+                         meta text not null,\
+                         error integer not null default 0,\
+                         fetched integer not null)')
+        self.cur.execute('CREATE INDEX IF NOT EXISTS metadata_fetched ON metadata(fetched)')
+        self.evict()
+
+    def get(self, url):
+        """Get fresh metadata for a url, or None if it isn't cached"""
+        with self.lock:
+            row = self.cur.execute('SELECT meta, error, fetched FROM metadata WHERE url == ?', (url,)).fetchone()
+            if row is not None:
+                meta, error, fetched = row
+                ttl = self.error_ttl if error else self.ttl
+                if fetched >= datetime.now().timestamp() - ttl:
+                    self.hits += 1
+                    metrics.inc('metadata_cache_hits')
+                    return json.loads(meta)
+            self.misses += 1
+            metrics.inc('metadata_cache_misses')
+            return None
+
+    def update(self, metas):
+        """Cache a dict of url -> fetched metadata, where failed
+        fetches are exceptions. Returns the entries as cached"""
+        ts = datetime.now().timestamp()
+        cached = {}
+        with self.lock:
+            for url, meta in metas.items():
+                error = isinstance(meta, Exception)
+                if error:
+                    meta = {'url': url, 'error': str(meta)}
+                self.cur.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                                 (url, json.dumps(meta), error, ts))
+                cached[url] = meta
+            self.con.commit()
+        return cached
+
+    def evict(self):
+        """Drop expired entries, then the oldest
+        entries beyond `max_size`"""
+        now = datetime.now().timestamp()
+        with self.lock:
+            self.cur.execute('DELETE FROM metadata WHERE fetched < ? OR (error AND fetched < ?)',
+                             (now - self.ttl, now - self.error_ttl))
+            self.cur.execute('DELETE FROM metadata WHERE url IN \
+                             (SELECT url FROM metadata ORDER BY fetched DESC LIMIT -1 OFFSET ?)',
+                             (self.max_size,))
+            self.con.commit()
+
+
+class RedirectCache:
+    """Disk-backed cache of where shortened urls redirect to.
+    Safe to share across threads."""
+    def __init__(self, path, ttl=30*24*60*60, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.cur = self.con.cursor()
+        self.cur.execute('CREATE TABLE IF NOT EXISTS redirects \
+                         (url text primary key,\
+                         target text not null,\
+                         resolved integer not null)')
+        self.cur.execute('CREATE INDEX IF NOT EXISTS redirects_resolved ON redirects(resolved)')
+        self.evict()
+
+    def get(self, url):
+        """Get where a url redirects to, or None if it isn't cached"""
+        with self.lock:
+            row = self.cur.execute('SELECT target FROM redirects WHERE url == ? AND resolved >= ?',
+                                   (url, datetime.now().timestamp() - self.ttl)).fetchone()
+        metrics.inc('redirect_cache_hits' if row is not None else 'redirect_cache_misses')
+        return row[0] if row is not None else None
+
+    def update(self, targets):
+        """Cache a dict of url -> where it redirects to"""
+        ts = datetime.now().timestamp()
+        with self.lock:
+            self.cur.executemany('INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)',
+                                 [(url, target, ts) for url, target in targets.items()])
+            self.con.commit()
+
+    def evict(self):
+        """Drop expired entries, then the oldest
+        entries beyond `max_size`"""
+        with self.lock:
+            self.cur.execute('DELETE FROM redirects WHERE resolved < ?',
+                             (datetime.now().timestamp() - self.ttl,))
+            self.cur.execute('DELETE FROM redirects WHERE url IN \
+                             (SELECT url FROM redirects ORDER BY resolved DESC LIMIT -1 OFFSET ?)',
+                             (self.max_size,))
+            self.con.commit()
+
+
+class MembershipCache:
+    """Disk-backed snapshots of friend/list memberships. Stale
+    snapshots are still returned, while a refresh runs in the background."""
+    def __init__(self, path, refresh_interval=6*60*60):
+        self.refresh_interval = refresh_interval
+        self.refreshing = set()
+        self.lock = Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.cur = self.con.cursor()
+        self.cur.execute('CREATE TABLE IF NOT EXISTS members \
+                         (name text primary key,\
+                         users text not null,\
+                         fetched integer not null)')
+        self.con.commit()
+
+    def get(self, name, fetch):
+        """Get the members for `name`, using `fetch` to get
+        them if there's no snapshot yet or it's out of date"""
+        with self.lock:
+            row = self.cur.execute('SELECT users, fetched FROM members WHERE name == ?', (name,)).fetchone()
+        if row is None:
+            return self._refresh(name, fetch)
+
+        users, fetched = row
+        if fetched < datetime.now().timestamp() - self.refresh_interval:
+            with self.lock:
+                start = name not in self.refreshing
+                self.refreshing.add(name)
+            if start:
+                Thread(target=self._refresh_background, args=(name, fetch), daemon=True).start()
+        return json.loads(users)
+
+    def _refresh(self, name, fetch):
+        metrics.inc('members_refreshes')
+        users = fetch()
+        with self.lock:
+            self.cur.execute('INSERT OR REPLACE INTO members VALUES (?, ?, ?)',
+                             (name, json.dumps(users), datetime.now().timestamp()))
+            self.con.commit()
+        return users
+
+    def _refresh_background(self, name, fetch):
+        try:
+            self._refresh(name, fetch)
+            logger.info('Refreshed members for {}'.format(name))
+        except Exception as e:
+            logger.error('Failed to refresh members for {}: {}'.format(name, e))
+        finally:
+            with self.lock:
+                self.refreshing.discard(name)
@@ -1,13 +1,95 @@
 import json
+import math
+import util
 import sqlite3
+import metrics
 from hashlib import md5
+from urllib.parse import quote
 from datetime import datetime
+from contextlib import contextmanager
 from collections import defaultdict
 
+SCHEMA_VERSION = 13
+
+# urls.users is no longer used, sharers are kept in url_users
+URL_COLUMNS = 'urls.url, \
+    (SELECT group_concat(user) FROM url_users WHERE url_users.url = urls.url), \
+    urls.count, urls.last_seen'
+
+# Contexts as grouped at ingest, ready to render, for the urls in a list or
+# subquery. They're added to urls already fetched with their url columns,
+# rather than repeating those columns for every context, see `_add_contexts`
+GROUPED_SQL = 'SELECT url, retweet, id, user, text, subs, repeats, retweeters FROM grouped \
+    WHERE url IN ({}) ORDER BY seq'
+
+# Pages of urls are keyed on last_seen then url, newest first,
+# so urls seen at the same time aren't skipped between pages
+SINCE_FILTER = 'WHERE urls.last_seen >= ? AND urls.count >= ? AND (urls.last_seen, urls.url) < (?, ?) \
+    ORDER BY urls.last_seen DESC, urls.url DESC LIMIT ?'
+SINCE_SQL = 'SELECT {} FROM urls {}'.format(URL_COLUMNS, SINCE_FILTER)
+SINCE_CONTEXT_SQL = GROUPED_SQL.format('SELECT url FROM urls {}'.format(SINCE_FILTER))
+
+# Urls are ranked by their sharers, each counting for half as much
+# every `HOT_HALF_LIFE` seconds. A sharer at time t adds exp(HOT_DECAY * t)
+# to a url's score, so scores don't need updating as time passes.
+# They're kept as logs, `ranking.hot`, so they don't overflow
+HOT_HALF_LIFE = 6*60*60
+HOT_DECAY = math.log(2)/HOT_HALF_LIFE
+
+# Pages of ranked urls are keyed on their score
+TOP_SQL = 'SELECT {}, ranking.hot FROM ranking CROSS JOIN urls ON urls.url = ranking.url \
+    WHERE ranking.hot < ? AND urls.last_seen >= ? ORDER BY ranking.hot DESC LIMIT ?'.format(URL_COLUMNS)
+
+# Each url and each context has its own document in the search index,
+# urls are ranked by their best matching document
+SEARCH_SQL = 'SELECT url, min(rank) AS score FROM search WHERE search MATCH ? \
+    GROUP BY url ORDER BY score LIMIT ? OFFSET ?'
+
+# Contexts' documents get positive rowids, urls' negative ones, see `search_rowid`
+CONTEXT_SEARCH_SQL = 'INSERT INTO search(rowid, url, text) VALUES \
+    ((SELECT coalesce(max(rowid), 0) + 1 FROM search WHERE rowid > 0), ?, ?)'
+
+# Queries that must be answered from indexes,
+# with example params for checking their plans
+INDEXED_QUERIES = [
+    (SINCE_SQL, (0, 1, float('inf'), '', -1)),
+    (SINCE_CONTEXT_SQL, (0, 1, float('inf'), '', -1)),
+    (TOP_SQL, (float('inf'), 0, -1)),
+]
+
+def search_text(text, sub):
+    """Text to index for a context: the tweet and its sub statuses"""
+    return ' '.join([text] + [s['text'] for s in sub])
+
+def search_rowid(url):
+    """The rowid of a url's own search document. Derived from the
+    url, so it survives a VACUUM, and negative so it can't collide
+    with contexts' documents, which are given positive rowids"""
+    return -1 - int(md5(url.encode('utf8')).hexdigest()[:15], 16)
+
+def logaddexp(a, b):
+    """log(exp(a) + exp(b)), without overflowing"""
+    hi, lo = max(a, b), min(a, b)
+    return hi + math.log1p(math.exp(lo - hi))
+
+
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, readonly=False):
+        """With `readonly=True` the connection can't write
+        and the schema is assumed to be set up already"""
+        if readonly:
+            self.con = sqlite3.connect('file:{}?mode=ro'.format(quote(path)), uri=True)
+            self.cur = self.con.cursor()
+            return
         self.con = sqlite3.connect(path)
         self.cur = self.con.cursor()
+        # Only takes effect for new databases, see `compact`
+        self.cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.cur.execute('PRAGMA journal_mode=WAL')
+        self.cur.execute('PRAGMA synchronous=NORMAL')
+        self.con.create_function('logaddexp', 2, logaddexp, deterministic=True)
+        self.con.create_function('search_rowid', 1, search_rowid, deterministic=True)
+        self._batch_depth = 0
         self.cur.execute('CREATE TABLE IF NOT EXISTS urls \
                          (url text primary key,\
                          users text not null default "",\
@@ -20,88 +102,494 @@ class Database:
                          user text not null,\
                          text text not null,\
                          sub text not null default "")')
+        self.cur.execute('CREATE TABLE IF NOT EXISTS url_users \
+                         (url text not null,\
+                         user text not null,\
+                         first_seen integer,\
+                         primary key (url, user))')
 
-    def inc(self, url, user):
-        ts = datetime.now().timestamp()
-        self.cur.execute('INSERT OR IGNORE INTO urls(url) VALUES (?)', (url,))
-
-        users = self.users(url)
-        if user not in users:
-            users.append(user)
-        count = len(users)
+        # Creating these also migrates existing databases
+        self.cur.execute('CREATE INDEX IF NOT EXISTS urls_last_seen_url ON urls(last_seen, url, count)')
+        self.cur.execute('CREATE INDEX IF NOT EXISTS context_url ON context(url)')
+        self._migrate()
 
-        self.cur.execute('UPDATE urls SET count = ?, last_seen = ?, users = ? WHERE url = ?',
-                         (count, ts, ','.join(users), url))
+    def _migrate(self):
+        version, = self.cur.execute('PRAGMA user_version').fetchone()
+        if version < 1:
+            # Move comma-joined urls.users into url_users
+            rows = self.cur.execute("SELECT url, users, last_seen FROM urls WHERE users != ''").fetchall()
+            self.cur.executemany('INSERT OR IGNORE INTO url_users VALUES (?, ?, ?)',
+                                 ((url, user, last_seen) for url, users, last_seen in rows
+                                  for user in users.split(',') if user))
+            self.cur.execute("UPDATE urls SET users = '', count = \
+                             (SELECT count(*) FROM url_users WHERE url_users.url = urls.url)")
+        if version < 2:
+            # Full-text search over urls, their page metadata, and contexts
+            self.cur.execute('ALTER TABLE urls ADD COLUMN title text')
+            self.cur.execute('ALTER TABLE urls ADD COLUMN description text')
+            self.cur.execute('CREATE VIRTUAL TABLE search USING fts5(url UNINDEXED, link, title, text)')
+            self.cur.execute("CREATE TRIGGER urls_search AFTER INSERT ON urls BEGIN \
+                             INSERT INTO search(url, link, title) VALUES (new.url, new.url, \
+                             coalesce(new.title, '') || ' ' || coalesce(new.description, '')); END")
+            self.cur.execute('INSERT INTO search(url, link) SELECT url, url FROM urls')
+            self.cur.executemany('INSERT INTO search(url, text) VALUES (?, ?)',
+                                 ((url, search_text(text, json.loads(sub)))
+                                  for url, text, sub in self.cur.execute('SELECT url, text, sub FROM context').fetchall()))
+        if version < 3:
+            # Bumped on every commit, so readers can tell when data changed
+            self.cur.execute('CREATE TABLE changes (version integer not null, modified integer)')
+            self.cur.execute('INSERT INTO changes VALUES (0, ?)', (datetime.now().timestamp(),))
+        if version < 4:
+            # Contexts grouped into deduped tweets and
+            # retweets (with their retweeters), see `_group_context`
+            self.cur.execute("CREATE TABLE grouped \
+                             (seq integer primary key,\
+                             url text not null,\
+                             key text not null,\
+                             retweet integer not null,\
+                             id text not null,\
+                             user text not null,\
+                             text text not null,\
+                             subs text not null default '',\
+                             repeats integer not null default 0,\
+                             retweeters text not null default '')")
+            self.cur.execute('CREATE UNIQUE INDEX grouped_key ON grouped(url, key)')
+            for id, url, user, text, sub in self.cur.execute('SELECT id, url, user, text, sub FROM context \
+                                                            ORDER BY rowid').fetchall():
+                self._group_context(id, url, user, text, json.loads(sub))
+        if version < 5:
+            # RSS feed items, oldest first
+            self.cur.execute('CREATE TABLE feed \
+                             (seq integer primary key,\
+                             link text not null unique,\
+                             title text,\
+                             description text,\
+                             pub_date text)')
+        if version < 6:
+            # Per-user fetch state: the last tweet id we saw from them,
+            # when we last fetched them, and how often they post
+            self.cur.execute('CREATE TABLE user_state \
+                             (user_id text primary key,\
+                             last_seen integer,\
+                             last_updated integer,\
+                             post_rate real)')
+        if version < 7:
+            # The feed keywords each context matched, as a json list
+            self.cur.execute("ALTER TABLE context ADD COLUMN keywords text not null default '[]'")
+        if version < 8:
+            # Time-decayed url scores, see `HOT_DECAY`
+            self.cur.execute('CREATE TABLE ranking \
+                             (url text primary key,\
+                             hot real not null)')
+            self.cur.execute('CREATE INDEX ranking_hot ON ranking(hot)')
+            hot = {}
+            for url, first_seen in self.cur.execute('SELECT url, first_seen FROM url_users \
+                                                    WHERE first_seen IS NOT NULL').fetchall():
+                w = first_seen * HOT_DECAY
+                hot[url] = logaddexp(hot[url], w) if url in hot else w
+            self.cur.executemany('INSERT INTO ranking VALUES (?, ?)', hot.items())
+        if version < 9:
+            # Give urls' search documents known rowids, so
+            # they can be updated when their title/description are
+            self.cur.execute('DROP TRIGGER urls_search')
+            self.cur.execute('DELETE FROM search WHERE link IS NOT NULL')
+            self.cur.execute("INSERT INTO search(rowid, url, link, title) \
+                             SELECT search_rowid(url), url, url, \
+                             coalesce(title, '') || ' ' || coalesce(description, '') FROM urls")
+            self.cur.execute("CREATE TRIGGER urls_search AFTER INSERT ON urls BEGIN \
+                             INSERT INTO search(rowid, url, link, title) VALUES (search_rowid(new.url), new.url, new.url, \
+                             coalesce(new.title, '') || ' ' || coalesce(new.description, '')); END")
+            self.cur.execute("CREATE TRIGGER urls_search_update AFTER UPDATE OF title, description ON urls \
+                             WHEN new.title IS NOT old.title OR new.description IS NOT old.description BEGIN \
+                             UPDATE search SET title = coalesce(new.title, '') || ' ' || coalesce(new.description, '') \
+                             WHERE rowid = search_rowid(new.url); END")
+        if version < 10:
+            # Replaced by urls_last_seen_url, for paging on (last_seen, url)
+            self.cur.execute('DROP INDEX IF EXISTS urls_last_seen')
+        if version < 11:
+            # Urls saved before they were normalized, see `util.normalize_url`
+            merges = [(url, util.normalize_url(url)) for url, in self.cur.execute('SELECT url FROM urls').fetchall()]
+            merges = [(url, into) for url, into in merges if into != url and util.normalize_url(into) == into]
+            if merges: self._merge_urls(merges)
+        if version < 12:
+            # Trimmed feed items are kept, without their title and
+            # description, so their links aren't published again
+            self.cur.execute('ALTER TABLE feed ADD COLUMN trimmed integer not null default 0')
+        if version < 13:
+            # Contexts' documents were given the next rowid, which after
+            # urls' documents were given negative ones could collide with them
+            docs = self.cur.execute('SELECT rowid, url, text FROM search WHERE rowid < 0 AND link IS NULL').fetchall()
+            self.cur.executemany('DELETE FROM search WHERE rowid = ?', ((rowid,) for rowid, _, _ in docs))
+            self.cur.executemany(CONTEXT_SEARCH_SQL, ((url, text) for _, url, text in docs))
+        self.cur.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
         self.con.commit()
 
-    def add_context(self, id, url, user, text, sub):
+    def _merge_urls(self, merges):
+        """Merge each url in `merges`, a list of (url, into) pairs, into the
+        `into` url, with their sharers, contexts, rankings and feed items"""
+        self.cur.execute('CREATE TEMP TABLE merging (url text primary key, into_url text not null)')
+        self.cur.executemany('INSERT INTO merging VALUES (?, ?)', merges)
+
+        # Sharers keep the first time they shared any of the urls
+        self.cur.execute('INSERT INTO url_users SELECT merging.into_url, user, first_seen \
+                         FROM url_users INNER JOIN merging ON url_users.url = merging.url WHERE true \
+                         ON CONFLICT(url, user) DO UPDATE SET first_seen = \
+                         coalesce(min(first_seen, excluded.first_seen), first_seen, excluded.first_seen)')
+        self.cur.execute('INSERT INTO urls(url, count, last_seen, title, description) \
+                         SELECT merging.into_url, 0, max(last_seen), max(title), max(description) \
+                         FROM urls INNER JOIN merging ON urls.url = merging.url WHERE true GROUP BY merging.into_url \
+                         ON CONFLICT(url) DO UPDATE SET last_seen = max(last_seen, excluded.last_seen), \
+                         title = coalesce(urls.title, excluded.title), \
+                         description = coalesce(urls.description, excluded.description)')
+        self.cur.execute('UPDATE urls SET count = (SELECT count(*) FROM url_users WHERE url_users.url = urls.url) \
+                         WHERE url IN (SELECT into_url FROM merging)')
+
+        # Context keys include their url. A tweet may already have a
+        # context for the url it's merged into, if so that one is kept
+        moved = []
+        for key, id, url, text, sub in self.cur.execute('SELECT key, id, into_url, text, sub FROM context \
+                                                        INNER JOIN merging ON context.url = merging.url').fetchall():
+            self.cur.execute('UPDATE OR IGNORE context SET key = ?, url = ? WHERE key = ?',
+                             ('{}-{}'.format(id, md5(url.encode('utf8')).hexdigest()), url, key))
+            if self.cur.rowcount: moved.append((url, search_text(text, json.loads(sub))))
+
+        self.cur.execute('DELETE FROM search WHERE url IN (SELECT url FROM merging)')
+        self.cur.executemany(CONTEXT_SEARCH_SQL, moved)
+        for table in ['url_users', 'context', 'urls']:
+            self.cur.execute('DELETE FROM {} WHERE url IN (SELECT url FROM merging)'.format(table))
+        self.cur.execute('UPDATE OR IGNORE feed SET link = \
+                         (SELECT into_url FROM merging WHERE merging.url = feed.link) \
+                         WHERE link IN (SELECT url FROM merging)')
+
+        # Regroup and rerank the merged urls from scratch
+        self.cur.execute('DELETE FROM grouped WHERE url IN (SELECT url FROM merging) \
+                         OR url IN (SELECT into_url FROM merging)')
+        for id, url, user, text, sub in self.cur.execute('SELECT id, url, user, text, sub FROM context \
+                                                        WHERE url IN (SELECT into_url FROM merging) \
+                                                        ORDER BY rowid').fetchall():
+            self._group_context(id, url, user, text, json.loads(sub))
+        self.cur.execute('DELETE FROM ranking WHERE url IN (SELECT url FROM merging) \
+                         OR url IN (SELECT into_url FROM merging)')
+        hot = {}
+        for url, first_seen in self.cur.execute('SELECT url, first_seen FROM url_users \
+                                                WHERE url IN (SELECT into_url FROM merging) \
+                                                AND first_seen IS NOT NULL').fetchall():
+            w = first_seen * HOT_DECAY
+            hot[url] = logaddexp(hot[url], w) if url in hot else w
+        self.cur.executemany('INSERT INTO ranking VALUES (?, ?)', hot.items())
+        self.cur.execute('DROP TABLE merging')
+
+    @contextmanager
+    def batch(self):
+        """Group writes into a single transaction,
+        committed on exit or rolled back on error"""
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            self._batch_depth -= 1
+            if not self._batch_depth: self.con.rollback()
+            raise
+        else:
+            self._batch_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if not self._batch_depth and self.con.in_transaction:
+            self.cur.execute('UPDATE changes SET version = version + 1, modified = ?',
+                             (datetime.now().timestamp(),))
+            self.con.commit()
+
+    def version(self):
+        """A counter bumped whenever writes are committed,
+        and when that last happened"""
+        return self.cur.execute('SELECT version, modified FROM changes').fetchone()
+
+    @metrics.timed('db_inc')
+    def inc(self, url, user, title=None, description=None):
+        ts = datetime.now().timestamp()
+        self.cur.execute('INSERT OR IGNORE INTO url_users VALUES (?, ?, ?)', (url, user, ts))
+        is_new = self.cur.rowcount
+        self.cur.execute('INSERT INTO urls(url, count, last_seen, title, description) VALUES (?, 1, ?, ?, ?) \
+                         ON CONFLICT(url) DO UPDATE SET \
+                         count = count + ?, last_seen = excluded.last_seen, \
+                         title = coalesce(urls.title, excluded.title), \
+                         description = coalesce(urls.description, excluded.description)',
+                         (url, ts, title, description, is_new))
+        if is_new:
+            self.cur.execute('INSERT INTO ranking VALUES (?, ?) ON CONFLICT(url) DO UPDATE SET \
+                             hot = logaddexp(hot, excluded.hot)', (url, ts * HOT_DECAY))
+        self._commit()
+
+    @metrics.timed('db_add_context')
+    def add_context(self, id, url, user, text, sub, keywords=None):
         key = '{}-{}'.format(id, md5(url.encode('utf8')).hexdigest())
-        sub = json.dumps(sub)
-        self.cur.execute('INSERT OR IGNORE INTO context VALUES (?, ?, ?, ?, ?, ?)', (key, id, url, user, text, sub))
+        self.cur.execute('INSERT OR IGNORE INTO context VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (key, id, url, user, text, json.dumps(sub), json.dumps(keywords or [])))
+        if self.cur.rowcount:
+            self.cur.execute(CONTEXT_SEARCH_SQL, (url, search_text(text, sub)))
+            self._group_context(id, url, user, text, sub)
+        self._commit()
 
-    def since(self, timestamp, min_count=1, with_context=False):
-        if with_context:
-            s = 'SELECT urls.*, context.id, context.user, context.text, context.sub FROM urls INNER JOIN context \
-                ON urls.url=context.url WHERE urls.last_seen >= ? AND urls.count >= ?'
-            results = self.cur.execute(s, (timestamp, min_count)).fetchall()
-            grouped = {}
-            for url, users, count, last_seen, id, user, text, sub in results:
-                if url not in grouped:
-                    grouped[url] = {
-                        'url': url,
-                        'users': users,
-                        'count': count,
-                        'last_seen': last_seen,
-                        'contexts': []
-                    }
-                grouped[url]['contexts'].append({
-                    'id': id,
-                    'user': user,
-                    'text': text,
-                    'sub': json.loads(sub)
-                })
-            return sorted(grouped.values(), key=lambda r: r['last_seen'])
+    def _group_context(self, id, url, user, text, sub):
+        if text.startswith('RT @'):
+            # Group the same retweets together
+            for s in sub:
+                self.cur.execute("INSERT INTO grouped(url, key, retweet, id, user, text, retweeters) \
+                                 VALUES (?, ?, 1, ?, ?, ?, ?) ON CONFLICT(url, key) DO UPDATE SET \
+                                 retweeters = CASE WHEN instr(' ' || retweeters || ' ', ' ' || excluded.retweeters || ' ') \
+                                    THEN retweeters ELSE retweeters || ' ' || excluded.retweeters END",
+                                 (url, 'rt-{}'.format(s['id']), s['id'], s['user'], util.make_links(s['text']), user))
         else:
-            s = 'SELECT * FROM urls WHERE last_seen >= ? AND count >= ?'
-            results = self.cur.execute(s, (timestamp, min_count)).fetchall()
-            return [{
-                'url': url,
-                'users': users,
-                'count': count,
-                'last_seen': last_seen
-            } for url, users, count, last_seen in results]
+            # Dedupe tweets with the same text
+            key = 't-{}'.format(md5(text.encode('utf8')).hexdigest())
+            self.cur.execute('INSERT INTO grouped(url, key, retweet, id, user, text, subs) \
+                             VALUES (?, ?, 0, ?, ?, ?, ?) ON CONFLICT(url, key) DO UPDATE SET \
+                             repeats = repeats + 1',
+                             (url, key, id, user, util.make_links(text), util.render_subs(sub)))
 
-    def users(self, url):
-        users, = self.cur.execute('SELECT users FROM urls WHERE url == ?', (url,)).fetchone()
-        return users.split(',') if users else []
-
-    def search(self, query):
-        results = []
-        query = '%{}%'.format(query)
-        s = 'SELECT urls.*, context.id, context.user, context.text, context.sub FROM urls INNER JOIN context \
-            ON urls.url=context.url WHERE urls.url LIKE ?'
-        results = self.cur.execute(s, (query,)).fetchall()
+    def _group(self, results):
         grouped = {}
-        for url, users, count, last_seen, id, user, text, sub in results:
+        for url, users, count, last_seen, retweet, id, user, text, subs, repeats, retweeters in results:
             if url not in grouped:
                 grouped[url] = {
                     'url': url,
                     'users': users,
                     'count': count,
                     'last_seen': last_seen,
-                    'contexts': []
+                    'tweets': [],
+                    'retweets': []
                 }
-            grouped[url]['contexts'].append({
-                'id': id,
-                'user': user,
-                'text': text,
-                'sub': json.loads(sub)
-            })
-        return sorted(grouped.values(), key=lambda r: r['last_seen'])
+            if retweet:
+                grouped[url]['retweets'].append({
+                    'id': id,
+                    'user': user,
+                    'text': text,
+                    'retweeters': retweeters.split()
+                })
+            else:
+                grouped[url]['tweets'].append({
+                    'id': id,
+                    'user': user,
+                    'text': text,
+                    'subs': subs,
+                    'repeats': repeats
+                })
+        return grouped
+
+    def since(self, timestamp, min_count=1, with_context=False, before=None, before_url=None, limit=None):
+        """Urls last seen since `timestamp`, oldest first.
+        `with_context` includes their grouped 'tweets' and 'retweets'.
+        For pagination, `limit` returns only the most recent urls
+        last seen before `before`, or at `before` with a url before
+        `before_url`; pass the first result's `last_seen` and `url`
+        as `before` and `before_url` to get the previous page."""
+        params = (timestamp, min_count,
+                  float('inf') if before is None else before,
+                  before_url or '',
+                  -1 if limit is None else limit)
+        results = [{
+            'url': url,
+            'users': users,
+            'count': count,
+            'last_seen': last_seen
+        } for url, users, count, last_seen in self.cur.execute(SINCE_SQL, params).fetchall()[::-1]]
+        if with_context:
+            # Only urls with contexts
+            self._add_contexts(results, self.cur.execute(SINCE_CONTEXT_SQL, params).fetchall())
+            results = [r for r in results if r['tweets'] or r['retweets']]
+        return results
+
+    def top(self, n, window=None, with_context=False, before=None, now=None):
+        """The `n` highest scoring urls last seen within the last `window`
+        seconds, best first. Each has its current 'score', roughly how many
+        people shared it recently, and its 'hot' ranking. For pagination,
+        pass the last result's 'hot' as `before` to get the next page."""
+        now = now or datetime.now().timestamp()
+        params = (float('inf') if before is None else before,
+                  0 if window is None else now - window, n)
+        results = [{
+            'url': url,
+            'users': users,
+            'count': count,
+            'last_seen': last_seen,
+            'hot': hot,
+            'score': math.exp(min(hot - now * HOT_DECAY, 700)),
+        } for url, users, count, last_seen, hot in self.cur.execute(TOP_SQL, params).fetchall()]
+
+        if with_context:
+            s = GROUPED_SQL.format(','.join('?' for _ in results))
+            self._add_contexts(results, self.cur.execute(s, [r['url'] for r in results]).fetchall())
         return results
 
+    def _add_contexts(self, results, rows):
+        """Add the grouped contexts in `rows`, from `GROUPED_SQL`,
+        to the url dicts in `results` as their 'tweets' and 'retweets'"""
+        urls = {r['url']: (r['users'], r['count'], r['last_seen']) for r in results}
+        grouped = self._group((url,) + urls[url] + tuple(context)
+                              for url, *context in rows if url in urls)
+        for r in results:
+            context = grouped.get(r['url'], {'tweets': [], 'retweets': []})
+            r['tweets'] = context['tweets']
+            r['retweets'] = context['retweets']
+
+    def users(self, url):
+        rows = self.cur.execute('SELECT user FROM url_users WHERE url == ? ORDER BY first_seen', (url,)).fetchall()
+        return [user for user, in rows]
+
+    def search(self, query, limit=50, offset=0):
+        """Full-text search over urls, their titles/descriptions,
+        and their contexts' text. Returns urls with their
+        grouped contexts, best match first"""
+        # Quote each term so input isn't parsed as fts5 query syntax
+        query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+        if not query: return []
+        ranked = [url for url, _ in self.cur.execute(SEARCH_SQL, (query, limit, offset)).fetchall()]
+        placeholders = ','.join('?' for _ in ranked)
+        results = {url: {
+            'url': url,
+            'users': users,
+            'count': count,
+            'last_seen': last_seen
+        } for url, users, count, last_seen in self.cur.execute(
+            'SELECT {} FROM urls WHERE url IN ({})'.format(URL_COLUMNS, placeholders), ranked).fetchall()}
+        results = [results[url] for url in ranked if url in results]
+        self._add_contexts(results, self.cur.execute(GROUPED_SQL.format(placeholders), ranked).fetchall())
+        # Only urls with contexts
+        return [r for r in results if r['tweets'] or r['retweets']]
+
+    def archivable(self, before, limit=1000):
+        """Urls last seen before `before`, oldest first, each
+        as a dict with their sharers, contexts and grouped contexts"""
+        records = []
+        for url, count, last_seen, title, description in self.cur.execute(
+                'SELECT url, count, last_seen, title, description FROM urls \
+                WHERE last_seen < ? ORDER BY last_seen LIMIT ?', (before, limit)).fetchall():
+            records.append({
+                'url': url,
+                'count': count,
+                'last_seen': last_seen,
+                'title': title,
+                'description': description,
+                'users': self.cur.execute('SELECT user, first_seen FROM url_users WHERE url = ?', (url,)).fetchall(),
+                'context': [{'id': id, 'user': user, 'text': text, 'sub': json.loads(sub or '[]'), 'keywords': json.loads(keywords)}
+                            for id, user, text, sub, keywords in self.cur.execute(
+                                'SELECT id, user, text, sub, keywords FROM context WHERE url = ? ORDER BY rowid', (url,))],
+                'grouped': [{'retweet': retweet, 'id': id, 'user': user, 'text': text,
+                             'subs': subs, 'repeats': repeats, 'retweeters': retweeters}
+                            for retweet, id, user, text, subs, repeats, retweeters in self.cur.execute(
+                                'SELECT retweet, id, user, text, subs, repeats, retweeters FROM grouped \
+                                WHERE url = ? ORDER BY seq', (url,))],
+            })
+        return records
+
+    def delete_urls(self, urls):
+        """Delete urls with their sharers and contexts. Their
+        search documents are left for `prune_search` to delete"""
+        self.cur.execute('CREATE TEMP TABLE IF NOT EXISTS deleting (url text primary key)')
+        self.cur.execute('DELETE FROM deleting')
+        self.cur.executemany('INSERT OR IGNORE INTO deleting VALUES (?)', ((url,) for url in urls))
+        for table in ['url_users', 'context', 'grouped', 'ranking', 'urls']:
+            self.cur.execute('DELETE FROM {} WHERE url IN (SELECT url FROM deleting)'.format(table))
+        self._commit()
+
+    def prune_search(self):
+        """Delete search documents for urls that no longer exist.
+        This scans the search index, so is done once after deleting"""
+        self.cur.execute('DELETE FROM search WHERE url NOT IN (SELECT url FROM urls)')
+        self._commit()
+
+    def compact(self, pages=None):
+        """Return up to `pages` free pages (default all) to the filesystem.
+        Databases created before incremental auto-vacuum are switched
+        to it the first time, which takes a full VACUUM"""
+        self.con.commit()
+        mode, = self.cur.execute('PRAGMA auto_vacuum').fetchone()
+        if mode != 2:
+            self.cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.cur.execute('VACUUM')
+        else:
+            # Each step frees a page, and executescript runs it to completion
+            self.cur.executescript('PRAGMA incremental_vacuum{};'.format('({:d})'.format(pages) if pages else ''))
+        self.cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    def in_feed(self, links):
+        """Which of these links already have feed items,
+        including ones since trimmed from the feed"""
+        return {link for link in links
+                if self.cur.execute('SELECT 1 FROM feed WHERE link == ?', (link,)).fetchone()}
+
+    def add_feed_items(self, items):
+        """Add feed items (dicts with 'link', 'title', 'description' and 'pubDate'),
+        skipping links already in the feed. Returns how many were added"""
+        added = 0
+        for item in items:
+            self.cur.execute('INSERT OR IGNORE INTO feed(link, title, description, pub_date) VALUES (?, ?, ?, ?)',
+                             (item['link'], item['title'], item['description'], item['pubDate']))
+            added += self.cur.rowcount
+        self._commit()
+        return added
+
+    def trim_feed(self, max_items):
+        """Drop all but the newest `max_items` feed items. Their links are
+        kept, so they aren't added again. Returns how many were dropped"""
+        self.cur.execute('UPDATE feed SET trimmed = 1, title = NULL, description = NULL \
+                         WHERE NOT trimmed AND seq NOT IN \
+                         (SELECT seq FROM feed WHERE NOT trimmed ORDER BY seq DESC LIMIT ?)', (max_items,))
+        removed = self.cur.rowcount
+        self._commit()
+        return removed
+
+    def feed_items(self):
+        """Feed items, newest first"""
+        return [{
+            'link': link,
+            'title': title,
+            'description': description,
+            'pubDate': pub_date
+        } for link, title, description, pub_date in
+            self.cur.execute('SELECT link, title, description, pub_date FROM feed \
+                             WHERE NOT trimmed ORDER BY seq DESC').fetchall()]
+
+    def user_state(self):
+        """Get dicts of user id -> last seen tweet id,
+        last updated timestamp, and post rate"""
+        last_seen, last_updated, post_rate = {}, {}, {}
+        for user_id, seen, updated, rate in self.cur.execute('SELECT * FROM user_state').fetchall():
+            if seen is not None: last_seen[user_id] = seen
+            if updated is not None: last_updated[user_id] = updated
+            if rate is not None: post_rate[user_id] = rate
+        return last_seen, last_updated, post_rate
+
+    def set_user_state(self, user_id, last_seen=None, last_updated=None, post_rate=None):
+        """Update a user's state, leaving out any `None` values"""
+        self.cur.execute('INSERT INTO user_state VALUES (?, ?, ?, ?) \
+                         ON CONFLICT(user_id) DO UPDATE SET \
+                         last_seen = coalesce(excluded.last_seen, last_seen), \
+                         last_updated = coalesce(excluded.last_updated, last_updated), \
+                         post_rate = coalesce(excluded.post_rate, post_rate)',
+                         (user_id, last_seen, last_updated, post_rate))
+        self._commit()
+
+    def query_plan(self, query, params=()):
+        """Get the `EXPLAIN QUERY PLAN` details for a query"""
+        return [detail for _, _, _, detail in
+                self.cur.execute('EXPLAIN QUERY PLAN {}'.format(query), params).fetchall()]
+
+    def check_query_plans(self):
+        """Get any `INDEXED_QUERIES` that would
+        do a full table scan, with their plans"""
+        full_scans = []
+        for query, params in INDEXED_QUERIES:
+            plan = self.query_plan(query, params)
+            if any(detail.startswith('SCAN') for detail in plan):
+                full_scans.append((query, plan))
+        return full_scans
+
 
 if __name__ == '__main__':
     db = Database('data/db')
+    for query, plan in db.check_query_plans():
+        print('Full scan:', query, plan)
     for r in db.since(0):
         print(r)
\ No newline at end of file
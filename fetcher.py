@@ -0,0 +1,256 @@
+import util
+import tweepy
+import logging
+import metrics
+from time import time, sleep
+from datetime import datetime
+from threading import Lock, local
+from collections import defaultdict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from metadata import get_metadata, get_metadata_many, is_short_url, resolve_redirects, SHORTENERS
+
+logger = logging.getLogger()
+
+# user_timeline allows 900 calls per 15 minute window
+TIMELINE_LIMIT = 900
+WINDOW = 15*60
+
+
+class RateBudget:
+    """Tracks an endpoint's remaining calls for the current
+    rate limit window, from the x-rate-limit-* response headers.
+    `acquire` blocks until the window resets once the budget is spent."""
+    def __init__(self, limit=TIMELINE_LIMIT, window=WINDOW):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset = time() + window
+        # Whether `reset` came from the headers, or is our own guess
+        self.reset_known = False
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                if now >= self.reset:
+                    self.remaining = self.limit
+                    self.reset = now + self.window
+                    self.reset_known = False
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    return
+                wait = self.reset - now
+            logger.info('Rate limited, pausing for {:.0f}s'.format(wait))
+            metrics.observe('rate_limit_wait', wait)
+            sleep(wait)
+
+    def update(self, headers):
+        try:
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = int(headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            if reset > self.reset or not self.reset_known:
+                # A new window has started, or we only had a guess
+                self.remaining = remaining
+                self.reset = reset
+                self.reset_known = True
+            elif reset == self.reset:
+                # Other calls may be in flight, so keep the lower count
+                self.remaining = min(self.remaining, remaining)
+            # Otherwise it's a late response from an earlier window
+
+    def exhaust(self, headers=None):
+        """Mark the budget as spent, e.g. after an unexpected 429"""
+        with self.lock:
+            self.remaining = 0
+            try:
+                self.reset = int(headers['x-rate-limit-reset'])
+                self.reset_known = True
+            except (KeyError, TypeError, ValueError):
+                if time() + self.window > self.reset:
+                    self.reset = time() + self.window
+                    self.reset_known = False
+
+
+class TimelineFetcher:
+    """Fetches user timelines within the rate limit, from up to
+    `workers` threads at a time (see `SharedFetcher.timelines_for`).
+    Once the limit is hit, fetching pauses until the window resets
+    and then carries on with the remaining users."""
+    def __init__(self, auth, workers=4, budget=None):
+        self.auth = auth
+        self.workers = workers
+        self.budget = budget or RateBudget()
+        self.local = local()
+
+    def _api(self):
+        # Each thread gets its own API, since it keeps the last response
+        if not hasattr(self.local, 'api'):
+            self.local.api = tweepy.API(self.auth, wait_on_rate_limit=False)
+        return self.local.api
+
+    def fetch_timeline(self, user_id, since_id):
+        api = self._api()
+        while True:
+            self.budget.acquire()
+            logger.info('Fetching user {}, last fetched id: {}'.format(user_id, since_id))
+            try:
+                with metrics.timer('timeline_fetch'):
+                    tweets = api.user_timeline(user_id=user_id, count=200, since_id=since_id, tweet_mode='extended')
+            except tweepy.error.RateLimitError as e:
+                metrics.inc('rate_limited')
+                self.budget.exhaust(getattr(e.response, 'headers', None))
+                continue
+            except tweepy.TweepError:
+                metrics.inc('timeline_errors')
+                logger.error('Failed to fetch tweets for user {}, their tweets may be protected'.format(user_id))
+                return None
+            if api.last_response is not None:
+                self.budget.update(api.last_response.headers)
+            return tweets
+
+
+class Coalescer:
+    """Runs each keyed call at most once. Callers asking for a key
+    that's already running wait for it and share its result.
+    Failed calls are forgotten, so they can be retried."""
+    def __init__(self):
+        self.calls = {}
+        self.lock = Lock()
+
+    def get(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                with self.lock:
+                    del self.calls[key]
+                future.set_exception(e)
+        else:
+            metrics.inc('coalesced', kind=key[0] if isinstance(key, tuple) else key)
+        return future.result()
+
+
+class SharedFetcher:
+    """Fetching for a single tick, shared by every feed. Each unique
+    list, timeline and url is fetched at most once, however many
+    feeds include it and even when the feeds run concurrently."""
+    def __init__(self, api, timelines, cache, members, redirects=None, shorteners=SHORTENERS):
+        self.api = api
+        self.timelines = timelines
+        self.cache = cache
+        self.members_cache = members
+        self.redirects = redirects
+        self.shorteners = shorteners
+        self.calls = Coalescer()
+        self.fetched_from = defaultdict(list)
+        self.lock = Lock()
+
+    def friends(self):
+        def fetch():
+            return [str(u_id) for u_id in tweepy.Cursor(self.api.friends_ids).items()]
+        return self.calls.get('friends', lambda: self.members_cache.get('friends', fetch))
+
+    def members(self, list_name):
+        def fetch():
+            user, slug = list_name.split('/')
+            return [str(u.id) for u in tweepy.Cursor(self.api.list_members, slug=slug, owner_screen_name=user).items()]
+        return self.calls.get(('members', list_name), lambda: self.members_cache.get(list_name, fetch))
+
+    def timeline(self, user_id, since_id):
+        """Tweets after `since_id`, or None if they couldn't be fetched.
+        These may go back further than `since_id`, since a timeline
+        fetched from an earlier tweet for another feed is reused"""
+        with self.lock:
+            fetched = self.fetched_from[user_id]
+            covering = [s for s in fetched if s is None or (since_id is not None and s <= since_id)]
+            if covering:
+                since_id = covering[0]
+            else:
+                fetched.append(since_id)
+        return self.calls.get(('timeline', user_id, since_id),
+                              lambda: self.timelines.fetch_timeline(user_id, since_id))
+
+    def timelines_for(self, user_ids, since_ids):
+        """Fetch timelines concurrently, returning
+        a dict of user id -> tweets or None"""
+        with ThreadPoolExecutor(max_workers=self.timelines.workers) as executor:
+            timelines = executor.map(lambda u: self.timeline(u, since_ids.get(u)), user_ids)
+            return dict(zip(user_ids, timelines))
+
+    def resolve(self, urls):
+        """Normalize urls, resolving shortened ones to where they
+        redirect. Returns a dict of url -> resolved url"""
+        normalized = {url: util.normalize_url(url) for url in urls}
+        short = {url for url in normalized.values() if is_short_url(url, self.shorteners)}
+        targets = {}
+        for url in short:
+            target = self.redirects.get(url) if self.redirects is not None else None
+            if target is not None: targets[url] = target
+        missing = [url for url in short if url not in targets]
+
+        def fetch(url):
+            logger.info('Resolving redirects: {}'.format(url))
+            with metrics.timer('redirect_resolve'):
+                return util.normalize_url(resolve_redirects(url))
+        fetched = get_metadata_many(missing, fetch=lambda url: self.calls.get(('redirect', url),
+                                                                             lambda: fetch(url)))
+        for url, target in list(fetched.items()):
+            if isinstance(target, Exception):
+                # Fall back to the short url, and try again next time
+                logger.info('Error resolving {}: {}'.format(url, target))
+                del fetched[url]
+        if self.redirects is not None:
+            self.redirects.update(fetched)
+        targets.update(fetched)
+        return {url: targets.get(n, n) for url, n in normalized.items()}
+
+    def metadata(self, urls):
+        """Get metadata for urls, fetching any that aren't cached"""
+        metas = {url: self.cache.get(url) for url in urls}
+        missing = [url for url, meta in metas.items() if meta is None]
+
+        def fetch(url):
+            logger.info('Fetching metadata: {}'.format(url))
+            if not metrics.enabled: return get_metadata(url)
+            host = metrics.label('host', urlparse(url).hostname)
+            try:
+                with metrics.timer('metadata_fetch', host=host):
+                    return get_metadata(url)
+            except Exception:
+                metrics.inc('metadata_errors', host=host)
+                raise
+        fetched = get_metadata_many(missing, fetch=lambda url: self.calls.get(('metadata', url),
+                                                                             lambda: fetch(url)))
+        for url, meta in fetched.items():
+            if isinstance(meta, Exception):
+                logger.info('Error getting metadata for {}: {}'.format(url, meta))
+        metas.update(self.cache.update(fetched))
+        return metas
+
+
+def estimate_post_rate(tweets, last_fetched, prev_rate=None, now=None):
+    """Estimate how many tweets per second a user posts, from
+    the tweets they posted since we last fetched their timeline"""
+    now = now or datetime.now().timestamp()
+    if last_fetched is not None and last_fetched > 0:
+        elapsed = now - last_fetched
+    elif len(tweets) > 1:
+        # First fetch, so go by the span of their recent tweets
+        oldest = min(t.created_at for t in tweets)
+        elapsed = datetime.utcnow().timestamp() - oldest.timestamp()
+    else:
+        return prev_rate
+    rate = len(tweets) / max(elapsed, 1)
+    if prev_rate is not None:
+        rate = (rate + prev_rate)/2
+    return rate
@@ -1,14 +1,19 @@
 import os
-import json
 import util
+import archive
 import config
 import tweepy
 import logging
+import metrics
+import metadata
 from time import sleep
 from dateutil import tz
 from db import Database
+from matcher import matcher_for
 from datetime import datetime
-from metadata import get_metadata
+from cache import MetadataCache, MembershipCache, RedirectCache
+from fetcher import TimelineFetcher, SharedFetcher, RateBudget, estimate_post_rate
+from concurrent.futures import ThreadPoolExecutor
 from feedgen.feed import FeedGenerator
 from apscheduler.schedulers.blocking import BlockingScheduler
 
@@ -18,109 +23,194 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Users whose timelines are collected
+# before resolving their urls together
+BATCH_SIZE = 100
 
-def process_feed(api, feed_conf, friends_cache, users_cache, urls_cache):
+# Tweets per second assumed for users
+# we don't have an estimate for yet
+DEFAULT_POST_RATE = 1/(24*60*60)
+
+# Metrics are written here after each tick, for the viewer's /metrics
+METRICS_PATH = 'data/metrics.prom'
+
+# The timeline rate limit carries over between ticks
+timeline_budget = RateBudget()
+
+
+def parse_tweet(t):
+    """Get the screen name, non-twitter urls,
+    and sub statuses (retweets/quotes) for a tweet"""
+    user = t.user.screen_name
+
+    sub_statuses = []
+    urls = [url['expanded_url'] for url in t.entities['urls']]
+    for attr in ['retweeted_status', 'quoted_status']:
+        if hasattr(t, attr):
+            sub_status = getattr(t, attr)
+            urls += [url['expanded_url'] for url in sub_status.entities['urls']]
+            sub_statuses.append({
+                'id': sub_status.id_str,
+                'user': sub_status.user.screen_name,
+                'text': sub_status.full_text,
+            })
+    urls = [url for url in set(urls) if not util.is_twitter_url(url)]
+    return user, urls, sub_statuses
+
+
+def migrate_json_state(db, data_dir):
+    """Feed items and per-user state used to be kept
+    in json files, move them into the feed's database"""
+    feed_path = os.path.join(data_dir, 'feed')
+    if os.path.exists(feed_path):
+        with db.batch():
+            db.add_feed_items(util.try_load_json(feed_path))
+        os.rename(feed_path, feed_path + '.migrated')
+
+    paths = [os.path.join(data_dir, name) for name in ['last_seen', 'last_updated', 'post_rate']]
+    if any(os.path.exists(path) for path in paths):
+        last_seen, last_updated, post_rate = [util.try_load_json(path) for path in paths]
+        with db.batch():
+            for user_id in set(last_seen) | set(last_updated) | set(post_rate):
+                db.set_user_state(user_id, last_seen.get(user_id),
+                                  last_updated.get(user_id), post_rate.get(user_id))
+        for path in paths:
+            if os.path.exists(path):
+                os.rename(path, path + '.migrated')
+
+
+def process_feed(shared, feed_conf):
     data_dir = 'data/{}'.format(feed_conf['id'])
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
     db = Database(os.path.join(data_dir, 'db'))
     now = datetime.now().timestamp()
-    last_seen_path = os.path.join(data_dir, 'last_seen')
-    last_seen = util.try_load_json(last_seen_path)
-    last_updated_path = os.path.join(data_dir, 'last_updated')
-    last_updated = util.try_load_json(last_updated_path)
+    migrate_json_state(db, data_dir)
+    last_seen, last_updated, post_rate = db.user_state()
     last_update = max(last_updated.values()) if last_updated else 0
     logger.info('Last updated: {}'.format(last_update))
 
-    compile_rss(db, last_update, data_dir, feed_conf)
+    compile_rss(db, last_update, feed_conf, shared)
 
-    if 'friends' not in friends_cache:
-        friends_cache['friends'] = [str(u_id) for u_id in tweepy.Cursor(api.friends_ids).items()]
-    users = friends_cache['friends']
+    users = set(shared.friends())
     for l in feed_conf['lists']:
-        if l not in friends_cache:
-            user, slug = l.split('/')
-            list_users = [str(u.id) for u in tweepy.Cursor(api.list_members, slug=slug, owner_screen_name=user).items()]
-            friends_cache[l] = list_users
-        users += friends_cache[l]
-    users = set(users)
-    users = {u: last_updated.get(u, -1) for u in users}
-    users = sorted(list(users), key=lambda u: users[u])
+        users.update(shared.members(l))
+    # Fetch users with the most tweets we haven't seen yet first,
+    # and users we've never fetched before anyone else
+    def priority(user_id):
+        last = last_updated.get(user_id, -1)
+        if last < 0: return float('inf')
+        return post_rate.get(user_id, DEFAULT_POST_RATE) * (now - last)
+    users = sorted(users, key=priority, reverse=True)
     logger.info('{} users'.format(len(users)))
 
-    try:
-        keywords = feed_conf.get('keywords', [])
-        for i, user_id in enumerate(users):
-            last = last_seen.get(user_id, None)
-            logger.info('Fetching user {}, last fetched id: {}'.format(user_id, last))
-            try:
-                if user_id in users_cache:
-                    tweets = users_cache[user_id]
-                else:
-                    tweets = api.user_timeline(user_id=user_id, count=200, since_id=last, tweet_mode='extended')
-                    users_cache[user_id] = tweets
-            except tweepy.TweepError:
-                logger.error('Failed to fetch tweets for user {}, their tweets may be protected'.format(user_id))
-                continue
-
+    matcher = matcher_for(feed_conf)
+    for start in range(0, len(users), BATCH_SIZE):
+        # Collect timelines for this batch of users first
+        batch = users[start:start+BATCH_SIZE]
+        fetched = shared.timelines_for(batch, last_seen)
+        timelines = []
+        for user_id in batch:
+            tweets = fetched[user_id]
+            if tweets is None: continue
+
+            # Timelines are shared with other feeds, and
+            # may include tweets this feed has already seen
+            last = last_seen.get(user_id)
+            tweets = [t for t in tweets if last is None or t.id > last]
+            parsed = []
             for t in tweets:
-                if not keywords or any(kw in t.full_text.lower() for kw in keywords):
-                    user = t.user.screen_name
-
-                    sub_statuses = []
-                    urls = [url['expanded_url'] for url in t.entities['urls']]
-                    for attr in ['retweeted_status', 'quoted_status']:
-                        if hasattr(t, attr):
-                            sub_status = getattr(t, attr)
-                            urls += [url['expanded_url'] for url in sub_status.entities['urls']]
-                            sub_statuses.append({
-                                'id': sub_status.id_str,
-                                'user': sub_status.user.screen_name,
-                                'text': sub_status.full_text,
-                            })
-
-                    for url in set(urls):
-                        if util.is_twitter_url(url): continue
-
-                        try:
-                            if url not in urls_cache:
-                                logger.info('Fetching metadata: {}'.format(url))
-                                urls_cache[url] = get_metadata(url)
-                            meta = urls_cache[url]
-                        except Exception as e:
-                            logger.info('Error getting metadata for {}: {}'.format(url, e))
-                            meta = {'url': url}
+                keywords = matcher.match(t.full_text)
+                if matcher and not keywords: continue
+                parsed.append((t, parse_tweet(t), keywords))
+            timelines.append((user_id, parsed, tweets))
+
+        # Then resolve all their urls in parallel, normalizing
+        # them first so variants of a url are only fetched once
+        resolved = shared.resolve({url for _, parsed, _ in timelines
+                                   for _, (_, urls, _), _ in parsed for url in urls})
+        metas = shared.metadata(set(resolved.values()))
+
+        # Urls are saved under their canonical url, which is what
+        # compile_rss will look them up by, so cache them under that too
+        canonical = {}
+        for url, meta in metas.items():
+            if 'error' in meta or not meta['url'].startswith('http'): continue
+            canonical_url = util.normalize_url(meta['url'])
+            if canonical_url != url: canonical[canonical_url] = meta
+        if canonical: shared.cache.update(canonical)
+
+        with db.batch():
+            for user_id, parsed, tweets in timelines:
+                for t, (user, urls, sub_statuses), keywords in parsed:
+                    for url in {resolved[url] for url in urls}:
+                        meta = metas[url]
 
                         # Sometimes the metadata canonical url will be a relative path,
                         # if that's the case just stick with the url we have
                         if meta['url'].startswith('http'):
-                            url = meta['url']
-                            if util.is_twitter_url(url): continue
+                            url = util.normalize_url(meta['url'])
+                        if util.is_twitter_url(url): continue
 
                         logger.info('@{}: {}'.format(user, url))
-                        db.inc(url, user)
-                        db.add_context(t.id_str, url, user, t.full_text, sub_statuses)
-
-                last = last_seen.get(user_id, None)
-                if last is None or t.id > last: last_seen[user_id] = t.id
-
-            last_updated[user_id] = now
-            with open(last_seen_path, 'w') as f:
-                json.dump(last_seen, f)
-            with open(last_updated_path, 'w') as f:
-                json.dump(last_updated, f)
-
-            if i % 100 == 0:
-                compile_rss(db, last_update, data_dir, feed_conf)
-
-    except tweepy.error.RateLimitError:
-        logger.info('Rate limited')
-
-    compile_rss(db, last_update, data_dir, feed_conf)
+                        db.inc(url, user, meta.get('title'), meta.get('description'))
+                        db.add_context(t.id_str, url, user, t.full_text, sub_statuses, keywords)
+
+                for t in tweets:
+                    last = last_seen.get(user_id, None)
+                    if last is None or t.id > last: last_seen[user_id] = t.id
+                rate = estimate_post_rate(tweets, last_updated.get(user_id), post_rate.get(user_id), now)
+                if rate is not None: post_rate[user_id] = rate
+                last_updated[user_id] = now
+
+                # Committed along with the user's urls and contexts
+                db.set_user_state(user_id, last_seen.get(user_id), now, rate)
+
+        compile_rss(db, last_update, feed_conf, shared)
+
+    compile_rss(db, last_update, feed_conf, shared)
+
+    # Move urls no one has shared in a while out of the database
+    retention = getattr(config, 'RETENTION_DAYS', None)
+    if retention:
+        with metrics.timer('archive'):
+            archived = archive.archive(db, os.path.join(data_dir, 'archive'), now - retention*24*60*60)
+        if archived:
+            logger.info('Archived {} urls'.format(archived))
     logger.info('Done: {}'.format(feed_conf['id']))
 
 
-def compile_rss(db, last_update, data_dir, feed_conf):
+@metrics.timed('compile_rss')
+def compile_rss(db, last_update, feed_conf, shared):
+    results = db.since(last_update, min_count=feed_conf['min_count'])
+    seen = db.in_feed([res['url'] for res in results])
+    results = [res for res in results if res['url'] not in seen]
+    metas = shared.metadata([res['url'] for res in results])
+
+    items = []
+    for res in results:
+        url = res['url']
+        users = res['users']
+        meta = metas[url]
+        if 'error' in meta:
+            logger.info('Skipping {}, no metadata: {}'.format(url, meta['error']))
+            continue
+
+        logger.info('Adding: {}'.format(url))
+        items.append({
+            'title': meta.get('title', '(No title)'),
+            'link': url,
+            'description': '[Saved by {}]\t{}'.format(users, meta.get('description', '(No description)')),
+            'pubDate': datetime.now(tz.tzlocal()).isoformat()
+        })
+
+    with db.batch():
+        added = db.add_feed_items(items)
+        removed = db.trim_feed(config.MAX_ITEMS)
+    if not added and not removed and os.path.exists(feed_conf['rss_path']):
+        logger.info('No new items for RSS')
+        return
+
     logger.info('Saving RSS...')
 
     # Compile RSS
@@ -128,53 +218,23 @@ def compile_rss(db, last_update, data_dir, feed_conf):
     fg.link(href=feed_conf['url'])
     fg.description('twitter chitter')
     fg.title('twitter chitter')
-    feed_path = os.path.join(data_dir, 'feed')
-    results = db.since(last_update, min_count=feed_conf['min_count'])
-
-    try:
-        feed = json.load(open(feed_path))
-    except FileNotFoundError:
-        feed = []
 
-    if results:
-        seen = [i['link'] for i in feed]
-
-        for res in results:
-            url = res['url']
-            users = res['users']
-            if url in seen: continue
-
-            logger.info('Adding: {}'.format(url))
-            try:
-                meta = get_metadata(url)
-            except Exception as e:
-                logger.info('Error getting metadata for {}: {}'.format(url, e))
-                continue
-
-            feed.append({
-                'title': meta.get('title', '(No title)'),
-                'link': url,
-                'description': '[Saved by {}]\t{}'.format(users, meta.get('description', '(No description)')),
-                'pubDate': datetime.now(tz.tzlocal()).isoformat()
-            })
-
-    for item in feed[::-1][:config.MAX_ITEMS]:
+    for item in db.feed_items():
         fe = fg.add_entry()
         fe.title(item['title'])
         fe.link(href=item['link'])
         fe.description(util.remove_control_characters(item['description']))
         fe.pubDate(item['pubDate'])
 
-    fg.rss_file(feed_conf['rss_path'])
-
-    with open(feed_path, 'w') as f:
-        json.dump(feed, f)
+    util.atomic_write(feed_conf['rss_path'], fg.rss_str())
 
     logger.info('Saved RSS to: {}'.format(feed_conf['rss_path']))
 
 
 def main():
     logger.info('Running...')
+    metrics.enable(getattr(config, 'METRICS', True))
+    start = metrics.snapshot()
 
     auth = tweepy.OAuthHandler(config.CONSUMER_KEY, config.CONSUMER_SECRET)
     auth.set_access_token(config.ACCESS_TOKEN, config.ACCESS_TOKEN_SECRET)
@@ -183,19 +243,42 @@ def main():
     # Use api.lists_all() to check list slugs,
     # not always what you'd expect
 
-    users_cache = {}
-    friends_cache = {}
-    urls_cache = {}
-    for feed_conf in config.FEEDS:
+    metadata.configure_session(
+        pool_hosts=getattr(config, 'POOL_HOSTS', metadata.POOL_HOSTS),
+        per_host=getattr(config, 'POOL_PER_HOST', metadata.POOL_PER_HOST),
+        max_connections=getattr(config, 'MAX_CONNECTIONS', metadata.MAX_CONNECTIONS),
+        retries=metadata.RETRIES.new(total=getattr(config, 'FETCH_RETRIES', metadata.RETRIES.total)))
+    cache = MetadataCache('data/metadata',
+                          ttl=getattr(config, 'METADATA_TTL', 7*24*60*60),
+                          max_size=getattr(config, 'METADATA_CACHE_SIZE', 100000))
+    timelines = TimelineFetcher(auth, workers=getattr(config, 'TIMELINE_WORKERS', 4),
+                                budget=timeline_budget)
+    members = MembershipCache('data/members',
+                              refresh_interval=getattr(config, 'MEMBERS_REFRESH_INTERVAL', 6*60*60))
+    redirects = RedirectCache('data/redirects',
+                              ttl=getattr(config, 'REDIRECTS_TTL', 30*24*60*60))
+    shared = SharedFetcher(api, timelines, cache, members, redirects,
+                           shorteners=getattr(config, 'SHORTENERS', metadata.SHORTENERS))
+
+    def run(feed_conf):
         succeeded = False
         while not succeeded:
             try:
-                process_feed(api, feed_conf, friends_cache, users_cache, urls_cache)
+                with metrics.timer('feed', feed=feed_conf['id']):
+                    process_feed(shared, feed_conf)
                 succeeded = True
             except tweepy.error.RateLimitError:
                 logger.info('Rate limited. Sleeping...')
                 sleep(60*15)
 
+    # Feeds run in parallel, sharing their fetching
+    with metrics.timer('tick'), ThreadPoolExecutor(max_workers=max(1, len(config.FEEDS))) as executor:
+        for _ in executor.map(run, config.FEEDS): pass
+    logger.info('Metadata cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+
+    if metrics.enabled:
+        logger.info('Tick: {}'.format(metrics.summary(start)))
+        util.atomic_write(METRICS_PATH, metrics.render().encode('utf8'))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,111 @@
+import re
+from functools import lru_cache
+from collections import defaultdict
+
+
+# Below this many terms, checking for each one in
+# the text is faster than the regex, see bench.py
+SCAN_TERMS = 100
+
+
+class KeywordMatcher:
+    """Matches many keywords against text, lowercased once (unless
+    matching case) and scanned with a single regex of their terms.
+    - `match_case`: match case-sensitively, otherwise case is ignored
+    - `whole_words`: keywords only match as whole words
+    - `phrases`: multi-word keywords match as a phrase, with any whitespace
+      between the words; otherwise all their words must appear, in any order"""
+    def __init__(self, keywords, match_case=False, whole_words=False, phrases=True):
+        self.keywords = list(dict.fromkeys(keywords))
+        self.normalize = (lambda t: ' '.join(t.split())) if match_case else (lambda t: ' '.join(t.lower().split()))
+
+        # The terms we search for, and which keywords need each
+        requires = {}
+        for kw in self.keywords:
+            requires[kw] = (self.normalize(kw),) if phrases else tuple(self.normalize(w) for w in kw.split())
+        terms = sorted({t for ts in requires.values() for t in ts if t}, key=len, reverse=True)
+        self.requires = requires
+        self.needed_by = defaultdict(list)
+        for kw, ts in requires.items():
+            for t in ts:
+                self.needed_by[t].append(kw)
+
+        self.terms = terms
+        # Whitespace only needs collapsing to match phrases
+        if not any(' ' in t for t in terms):
+            self.prepare = (lambda t: t) if match_case else str.lower
+        else:
+            self.prepare = self.normalize
+        self.term_ids = {t: i for i, t in enumerate(terms)}
+        self.scan = not whole_words and len(terms) < SCAN_TERMS
+        self.regex = _trie_regex(terms, whole_words)
+
+        # Only the longest term matches at a position,
+        # so note which other terms each one contains
+        term_regexes = [re.compile(_pattern(t, whole_words)) for t in terms]
+        self.contains = [{j for j, r in enumerate(term_regexes) if r.search(t)}
+                         for t in terms]
+
+    def __bool__(self):
+        return bool(self.keywords)
+
+    def match(self, text):
+        """Get the keywords matching `text`"""
+        if not self.keywords: return []
+        text = self.prepare(text)
+        if self.scan:
+            found = {t for t in self.terms if t in text}
+        else:
+            # Search again from just after each match's start,
+            # so that terms overlapping a match are still found
+            ids = set()
+            m = self.regex.search(text)
+            while m is not None:
+                ids |= self.contains[self.term_ids[m.group()]]
+                m = self.regex.search(text, m.start() + 1)
+            found = {self.terms[i] for i in ids}
+        if not found: return []
+        candidates = {kw for t in found for kw in self.needed_by[t]}
+        return [kw for kw in self.keywords
+                if kw in candidates and all(t in found for t in self.requires[kw])]
+
+
+def _pattern(term, whole_words):
+    p = re.escape(term)
+    return r'(?<!\w){}(?!\w)'.format(p) if whole_words else p
+
+
+def _trie_regex(terms, whole_words):
+    """Compile terms into a single regex whose alternatives share
+    their prefixes, so matching doesn't slow down as terms are added.
+    Prefers the longest term at each position."""
+    trie = {}
+    for term in terms:
+        node = trie
+        for c in term:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def build(node):
+        end = '' in node
+        alts = [re.escape(c) + build(child) for c, child in node.items() if c]
+        if not alts: return ''
+        if len(alts) == 1 and not end: return alts[0]
+        return '(?:{}){}'.format('|'.join(alts), '?' if end else '')
+
+    p = build(trie)
+    if whole_words:
+        p = r'(?<!\w)(?:{})(?!\w)'.format(p)
+    return re.compile(p)
+
+
+@lru_cache(maxsize=None)
+def _matcher(keywords, match_case, whole_words, phrases):
+    return KeywordMatcher(keywords, match_case, whole_words, phrases)
+
+def matcher_for(feed_conf):
+    """The keyword matcher for a feed config, built once per config"""
+    return _matcher(tuple(feed_conf.get('keywords', [])),
+                    feed_conf.get('match_case', False),
+                    feed_conf.get('whole_words', False),
+                    feed_conf.get('phrases', True))
@@ -1,5 +1,44 @@
+import re
+import codecs
 import requests
 import lxml.html
+import lxml.etree
+from threading import BoundedSemaphore, Lock
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from itertools import zip_longest, chain
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 16
+MAX_PER_HOST = 4
+
+# For streamed fetches
+CHUNK_SIZE = 16*1024
+MAX_HEAD_BYTES = 512*1024
+MAX_DRAIN_BYTES = 64*1024
+CHARSET_RE = re.compile(r'charset=([^;\s]+)', re.I)
+PRESCAN_BYTES = 1024
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', re.I)
+# Decoding with these drops the BOM
+BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+
+# Connection pooling
+POOL_HOSTS = 32
+POOL_PER_HOST = MAX_PER_HOST
+MAX_CONNECTIONS = MAX_WORKERS
+RETRIES = Retry(total=2, backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504))
+
+# Link shorteners, whose urls are resolved
+# to where they redirect before fetching metadata
+SHORTENERS = {
+    'bit.ly', 'j.mp', 'buff.ly', 'trib.al', 'ow.ly', 'dlvr.it', 'ift.tt',
+    'tinyurl.com', 'goo.gl', 'is.gd', 'fb.me', 'lnkd.in', 'wp.me', 'amzn.to',
+    'nyti.ms', 'wapo.st', 'reut.rs', 'bloom.bg', 'econ.st', 'on.ft.com',
+    'cnn.it', 'bbc.in', 'hubs.ly', 'shar.es', 'po.st', 'ti.me', 'politi.co',
+}
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:64.0) Gecko/20100101 Firefox/64.0',
@@ -13,16 +52,118 @@ def _get(d, *keys, default=None):
         return default
 
 
-def get_metadata(url):
-    resp = requests.head(url, headers=headers, timeout=5)
-    resp.raise_for_status()
+class PooledSession(requests.Session):
+    """A session keeping up to `per_host` keep-alive connections
+    for each of up to `pool_hosts` hosts, retrying failed requests
+    with backoff. `limit` caps requests in flight across all hosts."""
+    def __init__(self, pool_hosts=POOL_HOSTS, per_host=POOL_PER_HOST,
+                 max_connections=MAX_CONNECTIONS, retries=RETRIES):
+        super().__init__()
+        self.headers.update(headers)
+        self.per_host = per_host
+        self.max_connections = max_connections
+        self.limit = BoundedSemaphore(max_connections)
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=per_host,
+                              pool_block=True, max_retries=retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
-    if 'text/html' not in resp.headers.get('Content-Type'):
-        return {'url': url}
 
-    resp = requests.get(url, headers=headers, timeout=10)
-    resp.raise_for_status()
+_session = None
+_session_lock = Lock()
+
+def session():
+    """The shared session used for metadata fetches"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = PooledSession()
+        return _session
+
+def configure_session(**kwargs):
+    """Replace the shared session, see `PooledSession` for options"""
+    global _session
+    with _session_lock:
+        _session = PooledSession(**kwargs)
+
+
+def _drain(resp):
+    """Read the rest of a small response so its
+    connection can go back to the pool; otherwise
+    closing it will drop the connection"""
+    length = resp.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) <= MAX_DRAIN_BYTES:
+        try:
+            for _ in resp.iter_content(CHUNK_SIZE): pass
+        except requests.exceptions.StreamConsumedError:
+            # Already read to the end
+            pass
+
+
+def _charset(name):
+    """The charset if it's one we know, otherwise None"""
+    name = name.strip('"\'')
+    try:
+        return codecs.lookup(name) and name
+    except LookupError:
+        return None
+
+
+def _encoding(content_type, chunk):
+    """The encoding for a page, from its BOM, the charset in its Content-Type,
+    or a <meta> charset near its start, in that order. Otherwise utf-8,
+    since lxml would assume latin-1"""
+    for bom, encoding in BOMS:
+        if chunk.startswith(bom): return encoding
+    declared = CHARSET_RE.search(content_type)
+    encoding = declared and _charset(declared.group(1))
+    if encoding: return encoding
+    declared = META_CHARSET_RE.search(chunk)
+    encoding = declared and _charset(declared.group(1).decode('ascii'))
+    if encoding:
+        # A <meta> we could read as ascii can't really be utf-16, see the html spec
+        return 'utf-8' if codecs.lookup(encoding).name.startswith('utf-16') else encoding
+    return 'utf-8'
+
+
+def _parse_head(resp):
+    """Incrementally parse a streamed html response,
+    stopping at the end of its <head> or after `MAX_HEAD_BYTES`"""
+    # Read enough to look for a declared charset in
+    chunks = resp.iter_content(CHUNK_SIZE)
+    first = b''
+    for chunk in chunks:
+        first += chunk
+        if len(first) >= PRESCAN_BYTES: break
+
+    # Decoded here rather than by libxml2, which doesn't know every charset
+    encoding = _encoding(resp.headers.get('Content-Type', ''), first)
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = lxml.etree.HTMLPullParser(events=('start', 'end'))
 
+    meta = {}
+    read = 0
+    for chunk in chain([first], chunks):
+        parser.feed(decoder.decode(chunk))
+        for event, el in parser.read_events():
+            if event == 'start':
+                if el.tag == 'body': return meta
+            elif el.tag == 'head':
+                return meta
+            elif el.tag == 'meta':
+                prop = el.attrib.get('property', el.attrib.get('name'))
+                data = el.attrib.get('content')
+                if prop is not None and data is not None:
+                    meta[prop] = data
+            elif el.tag == 'link' and el.attrib.get('rel') == 'canonical' \
+                    and 'canonical' not in meta and 'href' in el.attrib:
+                meta['canonical'] = el.attrib['href']
+        read += len(chunk)
+        if read >= MAX_HEAD_BYTES: break
+    return meta
+
+
+def _parse_full(resp):
     html = lxml.html.fromstring(resp.content.decode('utf8'))
     tags = html.cssselect('meta[property], meta[name]')
 
@@ -36,10 +177,85 @@ def get_metadata(url):
     can = html.cssselect('link[rel="canonical"]')
     if can:
         meta['canonical'] = can[0].attrib['href']
+    return meta
+
+
+def get_metadata(url, stream=True):
+    """Get page metadata for a url. By default this makes
+    a single streamed GET and only reads as far as the page's <head>;
+    with `stream=False` it makes a HEAD request, then downloads
+    and parses the entire page."""
+    s = session()
+    if stream:
+        with s.limit, s.get(url, timeout=10, stream=True) as resp:
+            resp.raise_for_status()
+            if 'text/html' not in resp.headers.get('Content-Type', ''):
+                _drain(resp)
+                return {'url': url}
+            meta = _parse_head(resp)
+            _drain(resp)
+    else:
+        with s.limit:
+            resp = s.head(url, timeout=5)
+            resp.raise_for_status()
+
+            if 'text/html' not in resp.headers.get('Content-Type'):
+                return {'url': url}
+
+            resp = s.get(url, timeout=10)
+            resp.raise_for_status()
+        meta = _parse_full(resp)
 
     # Canonical data
     meta['url'] = _get(meta, 'canonical', 'og:url', default=url)
     meta['description'] = _get(meta, 'description', 'og:description', 'twitter:description')
     meta['title'] = _get(meta, 'og:title', 'twitter:title', url)
 
-    return meta
\ No newline at end of file
+    return meta
+
+
+def is_short_url(url, shorteners=SHORTENERS):
+    host = urlparse(url).hostname or ''
+    return host in shorteners or host.startswith('www.') and host[4:] in shorteners
+
+
+def resolve_redirects(url):
+    """Follow a url's redirects, returning where it ends up.
+    Tries a HEAD request first, since we don't need the page itself"""
+    s = session()
+    with s.limit:
+        resp = s.head(url, timeout=5, allow_redirects=True)
+        if resp.status_code in (403, 405, 501):
+            # Some servers don't support HEAD
+            with s.get(url, timeout=10, stream=True) as resp:
+                _drain(resp)
+    resp.raise_for_status()
+    return resp.url
+
+
+def get_metadata_many(urls, max_workers=None, max_per_host=None, fetch=get_metadata):
+    """Fetch metadata for many urls concurrently,
+    with at most `max_per_host` requests in flight to any one host.
+    These default to the shared session's connection limits.
+    Returns a dict of url -> metadata, or url -> exception
+    for urls that failed. `fetch` gets the metadata for one url."""
+    max_workers = max_workers or session().max_connections
+    max_per_host = max_per_host or session().per_host
+    by_host = defaultdict(list)
+    for url in urls:
+        by_host[urlparse(url).netloc].append(url)
+    limits = {host: BoundedSemaphore(max_per_host) for host in by_host}
+
+    def fetch_limited(url):
+        with limits[urlparse(url).netloc]:
+            try:
+                return fetch(url)
+            except Exception as e:
+                return e
+
+    # Interleave hosts so workers aren't all
+    # stuck waiting on the same host's limit
+    ordered = [url for urls in zip_longest(*by_host.values())
+               for url in urls if url is not None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(ordered, executor.map(fetch_limited, ordered)))
@@ -0,0 +1,169 @@
+import threading
+from time import perf_counter
+from bisect import bisect_left
+from functools import wraps
+from contextlib import nullcontext
+
+# Histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Distinct values kept for a label, see `label`
+MAX_LABEL_VALUES = 200
+
+PREFIX = 'audubon_'
+
+enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_label_values = {}
+_noop = nullcontext()
+
+
+def enable(on=True):
+    """Metrics are only recorded once enabled,
+    until then timers and counters do nothing"""
+    global enabled
+    enabled = on
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+def inc(name, n=1, **labels):
+    """Add `n` to the `name` counter"""
+    if not enabled: return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+def observe(name, seconds, **labels):
+    """Record a duration in the `name` histogram"""
+    if not enabled: return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram()
+        hist.observe(seconds)
+
+
+def timer(name, **labels):
+    """Time a `with` block into the `name` histogram"""
+    if not enabled: return _noop
+    return Timer(name, labels)
+
+
+def timed(name):
+    """Decorator timing each call into the `name` histogram"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            if not enabled: return fn(*args, **kwargs)
+            with Timer(name, {}):
+                return fn(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def label(kind, value):
+    """Keep a label's values bounded, values past
+    the first `MAX_LABEL_VALUES` are reported as 'other'"""
+    with _lock:
+        values = _label_values.setdefault(kind, set())
+        if value in values: return value
+        if len(values) < MAX_LABEL_VALUES:
+            values.add(value)
+            return value
+    return 'other'
+
+
+def snapshot():
+    """Current counter values and histogram
+    counts/sums, to summarize a span with `summary`"""
+    with _lock:
+        return dict(_counters), {key: (h.count, h.sum) for key, h in _histograms.items()}
+
+
+def summary(since=None):
+    """One line summarizing the counters and timers,
+    since an earlier `snapshot` if one is given"""
+    counters, hists = snapshot()
+    prev_counters, prev_hists = since or ({}, {})
+
+    # Totalled across labels
+    totals = {}
+    for key, value in counters.items():
+        totals[key[0]] = totals.get(key[0], 0) + value - prev_counters.get(key, 0)
+    timings = {}
+    for key, (count, sum) in hists.items():
+        prev_count, prev_sum = prev_hists.get(key, (0, 0))
+        total_count, total_sum = timings.get(key[0], (0, 0))
+        timings[key[0]] = (total_count + count - prev_count, total_sum + sum - prev_sum)
+
+    parts = ['{}: {} in {:.2f}s'.format(name, count, sum)
+             for name, (count, sum) in sorted(timings.items()) if count]
+    parts += ['{}: {}'.format(name, value) for name, value in sorted(totals.items()) if value]
+    return ', '.join(parts)
+
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels: return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def render():
+    """The metrics in the Prometheus text format"""
+    with _lock:
+        counters = sorted(_counters.items())
+        hists = sorted((key, list(h.counts), h.sum, h.count) for key, h in _histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        name = '{}{}_total'.format(PREFIX, name)
+        if name not in typed:
+            lines.append('# TYPE {} counter'.format(name))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+    for (name, labels), counts, sum, count in hists:
+        name = '{}{}_seconds'.format(PREFIX, name)
+        if name not in typed:
+            lines.append('# TYPE {} histogram'.format(name))
+            typed.add(name)
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += n
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), sum))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
@@ -1,196 +1,364 @@
 #!/usr/bin/env python3
 
-import re
+import archive
 import argparse
+import metrics
+import os
+import threading
+from time import perf_counter
 from db import Database
+from hashlib import md5
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import datetime, timedelta
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urlencode
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
 
-LINK_RE = re.compile('(https:\/\/t.co\/[A-Za-z0-9]+)')
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+VIEW_WINDOW = timedelta(days=2)
+CUTOFF_GRANULARITY = 10*60 # seconds
+
+HEAD = '''
+<html>
+    <head>
+        <meta charset="utf8">
+        <meta name="viewport" content="width=device-width,initial-scale=1">
+        <title>audubon</title>
+        <style>
+            html {
+                overflow-x: hidden;
+            }
+            article {
+                margin: 4em auto;
+                max-width: 720px;
+                line-height: 1.4;
+                padding-bottom: 4em;
+                border-bottom: 2px solid black;
+                font-family: sans-serif;
+            }
+            h4 {
+                position: sticky;
+                top: 0;
+                background: #fff;
+            }
+            .user {
+                color: #fff;
+                background: #333;
+                display: inline-block;
+                padding: 0 0.2em;
+                border-radius: 0.2em;
+            }
+            .context {
+                padding: 0.5em;
+                margin-bottom: 1em;
+                background: #d0e5f2;
+                border-radius: 0.2em;
+            }
+            .meta {
+                display: flex;
+                justify-content: space-between;
+                font-size: 0.8em;
+                margin: 1em 0 0;
+            }
+            .repeats {
+                font-style: italic;
+                color: #888;
+            }
+            a {
+                color: #1e5ae8;
+            }
+            ul, li {
+                list-style-type: none;
+            }
+            form {
+                width: 100%;
+                max-width: 720px;
+                margin: 1em auto;
+                display: flex;
+            }
+            form input[type="text"] {
+                flex: 1;
+                margin-right: 0.5em;
+            }
+            nav {
+                max-width: 720px;
+                margin: 1em auto 4em;
+                font-family: sans-serif;
+            }
+        </style>
+    </head>
+    <body>
+        <form method="get" action="/">
+            <input type="text" placeholder="Search urls, titles, tweets" name="query" />
+            <input type="submit" value="Search">
+        </form>
+'''
 
 parser = argparse.ArgumentParser(description='A simple server to view saved links in-context')
 parser.add_argument('-p', '--port', type=int, dest='PORT', default=8888, help='Port for server')
+parser.add_argument('-f', '--feed', type=str, dest='FEED', default='main', help='Id of the feed to view')
+parser.add_argument('-d', '--db', type=str, dest='DB', default=None, help='Path to the feed database, defaults to data/<feed>/db')
+parser.add_argument('-w', '--workers', type=int, dest='WORKERS', default=8, help='Number of worker threads')
+parser.add_argument('-c', '--cache-size', type=int, dest='CACHE_SIZE', default=64, help='Number of rendered pages to cache')
+parser.add_argument('-a', '--archive', type=str, dest='ARCHIVE', default=None, help='Path to the feed archive, defaults to next to the database')
+parser.add_argument('-m', '--metrics', type=str, dest='METRICS', default='data/metrics.prom', help='Path to the metrics written by main.py, served at /metrics')
+parser.add_argument('--no-metrics', action='store_true', dest='NO_METRICS', help="Don't record the viewer's own metrics")
 args = parser.parse_args()
+if args.DB is None:
+    args.DB = 'data/{}/db'.format(args.FEED)
+if args.ARCHIVE is None:
+    args.ARCHIVE = os.path.join(os.path.dirname(args.DB), 'archive')
+metrics.enable(not args.NO_METRICS)
+
+# Each worker thread keeps its own connection
+local = threading.local()
+
+def get_db():
+    if not hasattr(local, 'db'):
+        local.db = Database(args.DB, readonly=True)
+    return local.db
+
+
+def render_item(item):
+    html = []
+    html.append('''
+        <article>
+            <h4><a href="{href}">{href}</a></h4>'''.format(href=item['url']))
+    for t in item['tweets']:
+        html.append('''
+            <div class="context">
+                <div class="user">{user}</div>
+                {text}
+                <ul class="subs">{subs}</ul>
+                <div class="meta">
+                    <div class="repeats">{repeats}</div>
+                    <a href="https://twitter.com/i/web/status/{id}">Permalink</a>
+                </div>
+            </div>
+        '''.format(
+            id=t['id'],
+            user=t['user'],
+            text=t['text'],
+            repeats='Repeats {} times'.format(t['repeats']) if t['repeats'] > 0 else '',
+            subs=t['subs']))
+    for t in item['retweets']:
+        html.append('''
+            <div class="context">
+                <div class="user">{user}</div>
+                {text}
+                <div class="meta">
+                    <div class="retweeters">Retweeted by: {retweeters}</div>
+                    <a href="https://twitter.com/i/web/status/{id}">Permalink</a>
+                </div>
+            </div>
+        '''.format(
+            id=t['id'],
+            user=t['user'],
+            text=t['text'],
+            retweeters=' '.join('<span class="user">{}</span>'.format(u) for u in t['retweeters'])))
+    html.append('</article>')
+    return '\n'.join(html)
 
 
-def process_contexts(contexts):
-    tweets = {}
-    retweets = {}
-    text_to_id = {} # For deduping tweets
-    for c in contexts:
-        # Group the same retweets together
-        if c['text'].startswith('RT @'):
-            for s in c['sub']:
-                id = s['id']
-                if id not in retweets:
-                    retweets[id] = {
-                        'id': id,
-                        'user': s['user'],
-                        'text': make_links(s['text']),
-                        'retweeters': []
-                    }
-                retweets[id]['retweeters'].append(c['user'])
+def render_page(db, limit, query=None, page=0, before=None, before_url=None, cutoff=None, archived=False, sort=None):
+    """Render a page of search results (from the archive if `archived`),
+    or of urls last seen since `cutoff`, newest first or with `sort='hot'`
+    highest scoring first, yielding html as it goes"""
+    if query is not None:
+        if archived:
+            results = archive.search(args.ARCHIVE, query, limit=limit, offset=page*limit)
         else:
-            text = c['text']
-            if text in text_to_id:
-                id = text_to_id[text]
-                tweets[id]['repeats'] += 1
-            else:
-                id = c['id']
-                text_to_id[text] = id
-                tweets[id] = c
-                tweets[id]['text']  = make_links(c['text'])
-                tweets[id]['repeats'] = 0
-    return tweets.values(), retweets.values()
+            results = db.search(query, limit=limit, offset=page*limit)
+        next_page = {'query': query, 'page': page+1, 'limit': limit}
+        if archived: next_page['archived'] = 1
+    elif sort == 'hot':
+        window = VIEW_WINDOW.total_seconds()
+        results = db.top(limit, window=window, with_context=True,
+                         before=before, now=cutoff + window)
+        next_page = {'sort': 'hot', 'before': results[-1]['hot'], 'limit': limit} if results else None
+    else:
+        results = db.since(cutoff, min_count=2, with_context=True,
+                           before=before, before_url=before_url, limit=limit)
+        next_page = {'before': results[0]['last_seen'], 'before_url': results[0]['url'],
+                     'limit': limit} if results else None
+
+        # Reverse chron
+        results.reverse()
+
+    yield HEAD
+    for item in results:
+        yield render_item(item)
+
+    if len(results) == limit:
+        yield '<nav><a href="/?{}">Next page</a></nav>'.format(urlencode(next_page))
+    if query is not None and not archived and archive.archive_files(args.ARCHIVE):
+        yield '<nav><a href="/?{}">Search the archive</a></nav>'.format(
+            urlencode({'query': query, 'archived': 1, 'limit': limit}))
+    if query is None:
+        yield '<nav><a href="/">Latest</a></nav>' if sort == 'hot' else '<nav><a href="/?sort=hot">Hot</a></nav>'
+
+    yield '</body></html>'
+
+
+class RenderCache:
+    """LRU cache of rendered pages, shared by the worker threads"""
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+render_cache = RenderCache(args.CACHE_SIZE)
 
 
-def make_links(text):
-    return LINK_RE.sub(r'<a href="\1">\1</a>', text)
+class PooledHTTPServer(HTTPServer):
+    """Handles requests on a fixed pool of worker threads"""
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
 
 
 class AudubonRequestHandler(BaseHTTPRequestHandler):
+    # Chunked responses need HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def write_chunk(self, html):
+        data = html.encode('utf8')
+        chunk = '{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n' if data else b''
+        self.wfile.write(chunk)
+        return chunk
+
+    def not_modified(self, etag, modified):
+        match = self.headers.get('If-None-Match')
+        if match is not None:
+            return match.strip() == '*' or etag in [t.strip() for t in match.split(',')]
+        since = self.headers.get('If-Modified-Since')
+        if since is not None:
+            try:
+                return int(modified) <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_metrics(self):
+        # Ingestion metrics come from main.py, followed by our own
+        try:
+            with open(args.METRICS, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        data += metrics.render().encode('utf8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
     def do_GET(self):
-        db = Database('data/main/db')
+        start = perf_counter()
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            return self.send_metrics()
 
-        params = parse_qs(urlparse(self.path).query)
+        db = get_db()
+        version, modified = db.version()
+
+        params = parse_qs(url.query)
         query = params.get('query')
+        try:
+            limit = max(1, min(int(params.get('limit', [PAGE_SIZE])[0]), MAX_PAGE_SIZE))
+            page = max(0, int(params.get('page', [0])[0]))
+            before = params.get('before')
+            before = float(before[0]) if before is not None else None
+        except ValueError:
+            self.send_error(400, 'Invalid limit, page or before')
+            metrics.observe('viewer_request', perf_counter() - start, view='invalid', result='bad_request')
+            return
         if query is not None:
-            query = query[0]
-            results = db.search(query)
+            archived = params.get('archived', ['0'])[0] not in ('', '0')
+            view = {'query': query[0], 'page': page, 'limit': limit, 'archived': archived}
         else:
-            cutoff = datetime.now() - timedelta(days=2)
-            results = db.since(cutoff.timestamp(), min_count=2, with_context=True)
+            # Rounded so a render can be reused until the window moves on
+            cutoff = (datetime.now() - VIEW_WINDOW).timestamp()
+            cutoff -= cutoff % CUTOFF_GRANULARITY
+            view = {'before': before, 'limit': limit, 'cutoff': cutoff}
+            if params.get('sort', [None])[0] == 'hot':
+                view['sort'] = 'hot'
+            else:
+                view['before_url'] = params.get('before_url', [None])[0]
+            modified = max(modified, cutoff + VIEW_WINDOW.total_seconds())
 
-        # Reverse chron
-        results.reverse()
+        key = repr(sorted(view.items())).encode('utf8')
+        etag = '"{}-{}"'.format(version, md5(key).hexdigest())
+        view_name = 'search' if query is not None else view.get('sort', 'since')
+        if self.not_modified(etag, modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            metrics.observe('viewer_request', perf_counter() - start, view=view_name, result='not_modified')
+            return
 
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(modified, usegmt=True))
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
         self.end_headers()
 
-        html = ['''
-            <html>
-                <head>
-                    <meta charset="utf8">
-                    <meta name="viewport" content="width=device-width,initial-scale=1">
-                    <title>audubon</title>
-                    <style>
-                        html {
-                            overflow-x: hidden;
-                        }
-                        article {
-                            margin: 4em auto;
-                            max-width: 720px;
-                            line-height: 1.4;
-                            padding-bottom: 4em;
-                            border-bottom: 2px solid black;
-                            font-family: sans-serif;
-                        }
-                        h4 {
-                            position: sticky;
-                            top: 0;
-                            background: #fff;
-                        }
-                        .user {
-                            color: #fff;
-                            background: #333;
-                            display: inline-block;
-                            padding: 0 0.2em;
-                            border-radius: 0.2em;
-                        }
-                        .context {
-                            padding: 0.5em;
-                            margin-bottom: 1em;
-                            background: #d0e5f2;
-                            border-radius: 0.2em;
-                        }
-                        .meta {
-                            display: flex;
-                            justify-content: space-between;
-                            font-size: 0.8em;
-                            margin: 1em 0 0;
-                        }
-                        .repeats {
-                            font-style: italic;
-                            color: #888;
-                        }
-                        a {
-                            color: #1e5ae8;
-                        }
-                        ul, li {
-                            list-style-type: none;
-                        }
-                        form {
-                            width: 100%;
-                            max-width: 720px;
-                            margin: 1em auto;
-                            display: flex;
-                        }
-                        form input[type="text"] {
-                            flex: 1;
-                            margin-right: 0.5em;
-                        }
-                    </style>
-                </head>
-                <body>
-                    <form method="get" action="/">
-                        <input type="text" placeholder="Search for url" name="query" />
-                        <input type="submit" value="Search">
-                    </form>
-                ''']
-
-
-        for item in results:
-            html.append('''
-                <article>
-                    <h4><a href="{href}">{href}</a></h4>'''.format(href=item['url']))
-            tweets, retweets = process_contexts(item['contexts'])
-            for t in tweets:
-                html.append('''
-                    <div class="context">
-                        <div class="user">{user}</div>
-                        {text}
-                        <ul class="subs">{subs}</ul>
-                        <div class="meta">
-                            <div class="repeats">{repeats}</div>
-                            <a href="https://twitter.com/i/web/status/{id}">Permalink</a>
-                        </div>
-                    </div>
-                '''.format(
-                    id=t['id'],
-                    user=t['user'],
-                    text=t['text'],
-                    repeats='Repeats {} times'.format(t['repeats']) if t['repeats'] > 0 else '',
-                    subs='\n'.join('<li><em class="user">{user}</em>: {text}</li>'.format(
-                        user=s['user'],
-                        text=LINK_RE.sub(r'<a href="\1">\1</a>', s['text'])) for s in t['sub'])))
-            for t in retweets:
-                html.append('''
-                    <div class="context">
-                        <div class="user">{user}</div>
-                        {text}
-                        <div class="meta">
-                            <div class="retweeters">Retweeted by: {retweeters}</div>
-                            <a href="https://twitter.com/i/web/status/{id}">Permalink</a>
-                        </div>
-                    </div>
-                '''.format(
-                    id=t['id'],
-                    user=t['user'],
-                    text=t['text'],
-                    retweeters=' '.join('<span class="user">{}</span>'.format(u) for u in set(t['retweeters']))))
-            html.append('</article>')
-
-        html.append('</body></html>')
-
-        # Response
-        html = '\n'.join(html).encode('utf8')
-        self.wfile.write(html)
+        chunks = render_cache.get(etag)
+        cached = chunks is not None
+        if cached:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        else:
+            # Send each article as soon as it's rendered
+            chunks = [self.write_chunk(html) for html in render_page(db, **view)]
+            render_cache.set(etag, chunks)
+        self.wfile.write(b'0\r\n\r\n')
+        metrics.observe('viewer_request', perf_counter() - start, view=view_name,
+                        result='cached' if cached else 'rendered')
 
 
 if __name__ == '__main__':
-    print('Running on port', args.PORT)
-    server = HTTPServer(('localhost', args.PORT), AudubonRequestHandler)
+    # Worker connections are read-only, so set up or
+    # migrate the database first, in case main.py hasn't
+    Database(args.DB).con.close()
+
+    print('Running on port', args.PORT, 'for', args.DB)
+    server = PooledHTTPServer(('localhost', args.PORT), AudubonRequestHandler, args.WORKERS)
     server.serve_forever()
\ No newline at end of file
@@ -0,0 +1,294 @@
+import os
+import re
+import sys
+import types
+import random
+import tempfile
+import unittest
+from unittest import mock
+import archive
+import matcher
+from db import Database
+from fetcher import RateBudget
+from metadata import _parse_head
+
+
+class FakeResponse:
+    def __init__(self, body, content_type='text/html'):
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+
+    def iter_content(self, size):
+        # Small chunks, so characters get split across them
+        for i in range(0, len(self.body), 7):
+            yield self.body[i:i+7]
+
+
+class ParseHeadTest(unittest.TestCase):
+    def title(self, body, content_type='text/html'):
+        return _parse_head(FakeResponse(body, content_type)).get('og:title')
+
+    def page(self, head=''):
+        return '<html><head>{}<meta property="og:title" content="☃ snow"></head><body>'.format(head)
+
+    def test_header_charset(self):
+        self.assertEqual(self.title(self.page().encode('utf8'), 'text/html; charset=utf-8'), '☃ snow')
+        self.assertEqual(self.title(self.page().replace('☃', 'é').encode('latin-1'), 'text/html; charset=latin-1'), 'é snow')
+
+    def test_header_charset_wins(self):
+        page = self.page('<meta charset="utf-8">').replace('☃', 'é').encode('latin-1')
+        self.assertEqual(self.title(page, 'text/html; charset=iso-8859-1'), 'é snow')
+
+    def test_meta_charset(self):
+        page = self.page('<title>x</title><meta charset="windows-1252">').replace('☃', 'é').encode('cp1252')
+        self.assertEqual(self.title(page), 'é snow')
+        page = self.page('<meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">').replace('☃', 'é')
+        self.assertEqual(self.title(page.encode('latin-1')), 'é snow')
+
+    def test_no_charset(self):
+        self.assertEqual(self.title(self.page().encode('utf8')), '☃ snow')
+        self.assertEqual(self.title(self.page('<title>x</title>').encode('utf8')), '☃ snow')
+
+    def test_bom(self):
+        self.assertEqual(self.title(b'\xef\xbb\xbf' + self.page().encode('utf8')), '☃ snow')
+        self.assertEqual(self.title(self.page().encode('utf-16'), 'text/html; charset=latin-1'), '☃ snow')
+
+    def test_empty(self):
+        self.assertEqual(_parse_head(FakeResponse(b'')), {})
+
+
+class QueryPlanTest(unittest.TestCase):
+    def test_indexed_queries(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db = Database(os.path.join(dir, 'db'))
+            self.assertEqual(db.check_query_plans(), [])
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.dir.name, 'db'))
+
+    def tearDown(self):
+        self.db.con.close()
+        self.dir.cleanup()
+
+    def urls(self, query):
+        return [r['url'] for r in self.db.search(query)]
+
+    def test_title_added_later(self):
+        # e.g. the first metadata fetch failed
+        self.db.inc('https://a.example/', 'alice')
+        self.db.add_context('1', 'https://a.example/', 'alice', 'look', [])
+        self.assertEqual(self.urls('glaciers'), [])
+
+        self.db.inc('https://a.example/', 'bob', 'Glaciers retreat', 'Ice loss')
+        self.assertEqual(self.urls('glaciers'), ['https://a.example/'])
+        self.assertEqual(self.urls('ice'), ['https://a.example/'])
+
+    def test_title_kept(self):
+        self.db.inc('https://a.example/', 'alice', 'Glaciers retreat')
+        self.db.add_context('1', 'https://a.example/', 'alice', 'look', [])
+        self.db.inc('https://a.example/', 'bob', 'Something else')
+        self.assertEqual(self.urls('glaciers'), ['https://a.example/'])
+        self.assertEqual(self.urls('else'), [])
+        self.assertEqual(self.db.cur.execute('SELECT count(*) FROM search WHERE link IS NOT NULL').fetchone(), (1,))
+
+    def test_rowids(self):
+        # Urls' documents are negative, contexts' positive
+        self.db.inc('https://a.example/', 'alice')
+        self.db.add_context('1', 'https://a.example/', 'alice', 'look', [])
+        self.db.inc('https://b.example/', 'alice')
+        self.db.add_context('2', 'https://b.example/', 'alice', 'look', [])
+        self.assertEqual(self.db.cur.execute('SELECT rowid < 0, link IS NOT NULL FROM search ORDER BY rowid').fetchall(),
+                         [(1, 1), (1, 1), (0, 0), (0, 0)])
+
+
+class SinceTest(unittest.TestCase):
+    def test_pages_with_ties(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db = Database(os.path.join(dir, 'db'))
+            urls = ['https://{}.example/'.format(c) for c in 'abcde']
+            for url in urls:
+                db.inc(url, 'alice')
+            # Shared with the others at a page boundary
+            db.cur.execute('UPDATE urls SET last_seen = 100 WHERE url != ?', (urls[0],))
+            db.cur.execute('UPDATE urls SET last_seen = 200 WHERE url = ?', (urls[0],))
+
+            seen = []
+            before, before_url = None, None
+            while True:
+                page = db.since(0, before=before, before_url=before_url, limit=2)
+                if not page: break
+                seen = [r['url'] for r in page] + seen
+                before, before_url = page[0]['last_seen'], page[0]['url']
+            self.assertEqual(seen, sorted(urls[1:]) + urls[:1])
+            db.con.close()
+
+
+    def test_with_context(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db = Database(os.path.join(dir, 'db'))
+            for n, user in enumerate(['alice', 'bob', 'carol']):
+                db.inc('https://a.example/', user)
+                db.add_context(str(n), 'https://a.example/', user, 'look {}'.format(n), [])
+            db.inc('https://b.example/', 'alice')
+            results = db.since(0, with_context=True)
+            self.assertEqual([(r['url'], sorted(r['users'].split(','))) for r in results],
+                             [('https://a.example/', ['alice', 'bob', 'carol'])])
+            self.assertEqual([t['text'] for t in results[0]['tweets']], ['look 0', 'look 1', 'look 2'])
+            self.assertEqual([r['url'] for r in db.search('look')], ['https://a.example/'])
+            db.con.close()
+
+
+class CompileRssTest(unittest.TestCase):
+    class Shared:
+        def metadata(self, urls):
+            return {url: {'url': url, 'title': url} for url in urls}
+
+    def test_more_than_max_items(self):
+        # main reads its settings from config, as in bench.py
+        config = sys.modules.setdefault('config', types.ModuleType('config'))
+        import main
+        with tempfile.TemporaryDirectory() as dir, mock.patch.object(config, 'MAX_ITEMS', 3, create=True):
+            db = Database(os.path.join(dir, 'db'))
+            for n in range(5):
+                db.inc('https://a.example/{}'.format(n), 'alice')
+                db.inc('https://a.example/{}'.format(n), 'bob')
+            feed_conf = {'min_count': 2, 'url': 'http://localhost/feed.xml',
+                         'rss_path': os.path.join(dir, 'feed.xml')}
+            main.compile_rss(db, 0, feed_conf, self.Shared())
+            feed = [item['link'] for item in db.feed_items()]
+            self.assertEqual(len(feed), 3)
+
+            modified = os.stat(feed_conf['rss_path']).st_mtime_ns
+            for _ in range(3):
+                main.compile_rss(db, 0, feed_conf, self.Shared())
+                self.assertEqual([item['link'] for item in db.feed_items()], feed)
+            self.assertEqual(os.stat(feed_conf['rss_path']).st_mtime_ns, modified)
+            db.con.close()
+
+
+class RateBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.slept = []
+        def sleep(seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+        patches = [mock.patch('fetcher.time', lambda: self.now), mock.patch('fetcher.sleep', sleep)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def headers(self, remaining, reset):
+        return {'x-rate-limit-remaining': str(remaining), 'x-rate-limit-reset': str(reset)}
+
+    def test_earlier_reset(self):
+        budget = RateBudget()
+        budget.update(self.headers(5, self.now + 60))
+        for _ in range(6):
+            budget.acquire()
+        self.assertEqual(self.slept, [60])
+
+    def test_late_response(self):
+        budget = RateBudget()
+        budget.update(self.headers(3, self.now + 60))
+        budget.update(self.headers(10, self.now + 60))
+        self.assertEqual(budget.remaining, 3)
+
+        # A new window, then a response from the one before it
+        budget.update(self.headers(899, self.now + 900))
+        budget.update(self.headers(1, self.now + 60))
+        self.assertEqual((budget.remaining, budget.reset), (899, self.now + 900))
+
+
+class MergeUrlsTest(unittest.TestCase):
+    def test_migrate(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'db')
+            db = Database(path)
+            url = 'https://a.example/x'
+            db.inc('HTTPS://A.example/x?utm_source=t', 'alice', 'Glaciers')
+            db.add_context('1', 'HTTPS://A.example/x?utm_source=t', 'alice', 'look', [])
+            db.inc(url, 'bob')
+            db.add_context('2', url, 'bob', 'look', [])
+            db.inc(url + '#top', 'alice')
+            db.add_context('1', url + '#top', 'alice', 'look', [])
+            db.inc('https://b.example/', 'carol')
+            # As it was at version 10
+            db.cur.execute('ALTER TABLE feed DROP COLUMN trimmed')
+            db.cur.execute('PRAGMA user_version = 10')
+            db.con.commit()
+            db.con.close()
+
+            db = Database(path)
+            self.assertEqual([(r['url'], r['count']) for r in db.since(0)],
+                             [(url, 2), ('https://b.example/', 1)])
+            self.assertEqual(db.cur.execute('SELECT count(*), count(DISTINCT id) FROM context').fetchone(), (2, 2))
+            self.assertEqual(db.cur.execute('SELECT url, repeats FROM grouped').fetchall(), [(url, 1)])
+            self.assertEqual(db.cur.execute('SELECT count(*) FROM ranking').fetchone(), (2,))
+            self.assertEqual([r['url'] for r in db.search('glaciers')], [url])
+            self.assertEqual([r['url'] for r in db.search('look')], [url])
+            self.assertEqual(db.cur.execute('SELECT count(*) FROM search').fetchone(), (4,))
+            self.assertEqual(db.check_query_plans(), [])
+            db.con.close()
+
+
+class ArchiveSearchTest(unittest.TestCase):
+    def record(self, n, text):
+        return {'url': 'https://a.example/{}'.format(n), 'title': None, 'description': None,
+                'users': [], 'count': 1, 'last_seen': n, 'grouped': [],
+                'context': [{'text': text, 'sub': []}]}
+
+    def test_newest_first(self):
+        with tempfile.TemporaryDirectory() as dir:
+            rand = random.Random(0)
+            records = [self.record(n, rand.choice(['ice', 'snow'])) for n in range(200)]
+            for month in ['2020-01', '2020-02']:
+                # Out of order, and some archived twice
+                batch = rand.sample(records, 100) + rand.sample(records, 20)
+                archive._write(os.path.join(dir, month + '.ndjson.gz'), batch)
+            expected = {}
+            for month in ['2020-02', '2020-01']:
+                for r in archive._read(os.path.join(dir, month + '.ndjson.gz')):
+                    if r['context'][0]['text'] == 'ice' and r['url'] not in expected:
+                        expected[r['url']] = (month, r['last_seen'])
+            expected = sorted(expected, key=lambda url: expected[url], reverse=True)
+            for offset, limit in [(0, 10), (5, 50), (90, 30), (0, 500)]:
+                self.assertEqual([r['url'] for r in archive.search(dir, 'ice', limit, offset)],
+                                 expected[offset:offset+limit])
+
+
+class MatcherTest(unittest.TestCase):
+    def match(self, keywords, text, **kwargs):
+        return matcher.KeywordMatcher(keywords, **kwargs).match(text)
+
+    def test_options(self):
+        keywords = ['sea level', 'level rise', 'Climate', '#cop26']
+        text = 'SEA   level rise at #COP26, climatechange'
+        self.assertEqual(self.match(keywords, text), keywords)
+        self.assertEqual(self.match(keywords, text, whole_words=True), ['sea level', 'level rise', '#cop26'])
+        self.assertEqual(self.match(keywords, text, match_case=True), ['level rise'])
+        self.assertEqual(self.match(['rise sea'], text), [])
+        self.assertEqual(self.match(['rise sea'], text, phrases=False), ['rise sea'])
+
+    def test_overlapping(self):
+        # Overlapping and nested keywords, found
+        # both by scanning and with the regex
+        rand = random.Random(0)
+        words = ['ab', 'abc', 'bc', 'cab', 'b c', 'c a', 'ca']
+        try:
+            for _ in range(200):
+                keywords = rand.sample(words, rand.randint(1, len(words)))
+                text = ' '.join(rand.choice(words) for _ in range(rand.randint(1, 6))).upper()
+                expected = [kw for kw in keywords if kw in text.lower()]
+                for matcher.SCAN_TERMS in [0, len(keywords) + 1]:
+                    self.assertEqual(self.match(keywords, text), expected, (keywords, text))
+                expected = [kw for kw in keywords if re.search(r'(?<!\w){}(?!\w)'.format(kw), text.lower())]
+                self.assertEqual(self.match(keywords, text, whole_words=True), expected, (keywords, text))
+        finally:
+            matcher.SCAN_TERMS = 100
+
+if __name__ == '__main__':
+    unittest.main()
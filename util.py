@@ -1,11 +1,51 @@
+import os
 import re
 import json
+import tempfile
+from urllib.parse import urlsplit, urlunsplit
 
 TWITTER_RE = re.compile('https?:\/\/twitter\.com')
+LINK_RE = re.compile('(https:\/\/t.co\/[A-Za-z0-9]+)')
 
 def is_twitter_url(url):
     return TWITTER_RE.match(url) is not None
 
+# Query params that only track where a link was shared from
+TRACKING_PARAMS = {'fbclid', 'gclid', 'igshid', 'mc_cid', 'mc_eid'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url):
+    """Normalize a url so its variants are counted together. Lowercases
+    the scheme and host, and drops default ports, fragments, and
+    tracking params (utm_* etc). Other urls are returned as they are"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname: return url
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+
+    host = parts.hostname.rstrip('.')
+    if ':' in host: host = '[{}]'.format(host)
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        host = '{}:{}'.format(host, port)
+    query = '&'.join(p for p in parts.query.split('&')
+                     if p and not _is_tracking_param(p.split('=', 1)[0]))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+def _is_tracking_param(key):
+    key = key.lower()
+    return key.startswith('utm_') or key in TRACKING_PARAMS
+
+def make_links(text):
+    return LINK_RE.sub(r'<a href="\1">\1</a>', text)
+
+def render_subs(sub):
+    """Render a tweet's sub statuses as <li> items"""
+    return '\n'.join('<li><em class="user">{user}</em>: {text}</li>'.format(
+        user=s['user'], text=make_links(s['text'])) for s in sub)
+
 def try_load_json(path):
     try:
         with open(path, 'r') as f:
@@ -13,6 +53,19 @@ def try_load_json(path):
     except FileNotFoundError:
         return {}
 
+def atomic_write(path, data):
+    """Write bytes to a temp file, then move it to `path`,
+    so readers never see a partially written file"""
+    dir = os.path.dirname(os.path.abspath(path))
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        mode = 0o644
+    with tempfile.NamedTemporaryFile(dir=dir, delete=False) as f:
+        f.write(data)
+    os.chmod(f.name, mode)
+    os.replace(f.name, path)
+
 # <https://github.com/html5lib/html5lib-python/issues/96#issuecomment-625190231>
 # A regex matching the "invalid XML character range"
 ILLEGAL_XML_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]")